@@ -0,0 +1,111 @@
+import numpy as np
+
+labelMap = [
+    "down",
+    "front",
+    "step"
+]
+
+# every label but the step is an escalator view
+STEP_LABEL = labelMap.index("step")
+
+box_dtype = np.dtype([
+    ("label", np.int64),
+    ("confidence", np.float64),
+    # xmin, ymin, xmax, ymax in pixels
+    ("box", np.int64, (4,)),
+])
+
+
+def detection_boxes(detections, shape):
+    # every detection of a frame at once, scaled and clipped to <0..1> and truncated to pixels
+    raw = np.array([(d.label, d.confidence, d.xmin, d.ymin, d.xmax, d.ymax) for d in detections],
+                   np.float64).reshape(-1, 6)
+    boxes = np.empty(len(raw), box_dtype)
+    boxes["label"] = raw[:, 0]
+    boxes["confidence"] = raw[:, 1]
+    boxes["box"] = (np.clip(raw[:, 2:], 0, 1) * (shape[1], shape[0], shape[1], shape[0])).astype(int)
+    return boxes
+
+
+def overlap_matrix(a, b):
+    # (len(a), len(b)) booleans, True where the boxes share area, edges touching is no overlap
+    a = a[:, None, :]
+    b = b[None, :, :]
+    return ((a[..., 2] > b[..., 0]) & (b[..., 2] > a[..., 0]) &
+            (a[..., 3] > b[..., 1]) & (b[..., 3] > a[..., 1]))
+
+
+def iou_matrix(a, b):
+    # (len(a), len(b)) intersection over union of two box arrays
+    a = a[:, None, :].astype(np.float64)
+    b = b[None, :, :].astype(np.float64)
+    width = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    height = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = width * height
+    union = ((a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1]) +
+             (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1]) - inter)
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def nearest_escalator_step(boxes, shape):
+    # (escalator label, box of the first step overlapping the escalator nearest the frame center),
+    # or None when there is no such escalator or step
+    escalators = boxes[boxes["label"] != STEP_LABEL]
+    if len(escalators) == 0:
+        return None
+    esc = escalators["box"]
+    centers = (esc[:, :2] + esc[:, 2:]) // 2
+    dist = ((centers - (shape[1] // 2, shape[0] // 2)) ** 2).sum(axis=1)
+    steps = boxes["box"][boxes["label"] == STEP_LABEL]
+    overlaps = overlap_matrix(esc, steps)
+    nearest = int(np.argmin(dist))
+    if not overlaps[nearest].any():
+        return None
+    return int(escalators["label"][nearest]), steps[np.argmax(overlaps[nearest])].tolist()
+
+
+class BoxTracker:
+    # Follows detections across frames by IoU, so an escalator and a step found in different frames
+    # can still be paired. A track keeps its latest box and an exponentially weighted confidence,
+    # the detection confidence when matched and 0 when missed.
+    def __init__(self, iouThreshold=0.3, alpha=0.3, minConfidence=0.25, maxMissed=5):
+        self.iouThreshold = iouThreshold
+        # weight of the newest frame in a track's confidence
+        self.alpha = alpha
+        # tracks below this are not used, tracks missed more than maxMissed frames are dropped
+        self.minConfidence = minConfidence
+        self.maxMissed = maxMissed
+        self.reset()
+
+    def reset(self):
+        self.tracks = np.empty(0, box_dtype)
+        self.missed = np.empty(0, np.int64)
+
+    def update(self, boxes):
+        # boxes: the detection_boxes() of the next frame
+        tracks = self.tracks
+        matched = np.zeros(len(tracks), bool)
+        used = np.zeros(len(boxes), bool)
+        if len(tracks) and len(boxes):
+            iou = iou_matrix(tracks["box"], boxes["box"])
+            iou[tracks["label"][:, None] != boxes["label"][None, :]] = 0
+            # greedy, best overlapping pairs first
+            for t, d in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, d] < self.iouThreshold:
+                    break
+                if matched[t] or used[d]:
+                    continue
+                matched[t] = used[d] = True
+                tracks["box"][t] = boxes["box"][d]
+                tracks["confidence"][t] += self.alpha * (boxes["confidence"][d] - tracks["confidence"][t])
+        tracks["confidence"][~matched] *= 1 - self.alpha
+        self.missed[matched] = 0
+        self.missed[~matched] += 1
+        keep = self.missed <= self.maxMissed
+        self.tracks = np.concatenate([tracks[keep], boxes[~used]])
+        self.missed = np.concatenate([self.missed[keep], np.zeros(np.count_nonzero(~used), np.int64)])
+
+    def confident(self):
+        # the tracks worth acting on, in the detection_boxes() layout
+        return self.tracks[self.tracks["confidence"] >= self.minConfidence]
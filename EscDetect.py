@@ -1,71 +1,70 @@
 import cv2
 import numpy as np
 import time
+from collections import deque
 from math import atan2, degrees
-import math
 # update
 import depthai as dai
-import uuid
 
-
-def resize_frame(frame):
-    return cv2.resize(frame, (640, 640))
+from Detections import BoxTracker, detection_boxes, nearest_escalator_step
+from FrameReader import FrameSync, LatestFrameReader, device_clock
+from FrameSink import FrameSink
+from LazyFrame import LazyFrame
 
 
 def gray_scale_frame(frame):
     return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
 
-def is_boxes_overlap(R1, R2):
-    r1_x1, r1_y1, r1_x2, r1_y2 = R1
-    r2_x1, r2_y1, r2_x2, r2_y2 = R2
-    # Return False if no overlap possible on X-Axis
-    if r1_x2 <= r2_x1 or r2_x2 <= r1_x1:
-        return False
-    # Return False if no overlap possible on Y-Axis
-    if r1_y2 <= r2_y1 or r2_y2 <= r1_y1:
-        return False
-    return True
-
-
-# nn data, being the bounding box locations, are in <0..1> range - they need to be normalized with frame width/height
-def frame_norm(frame, bbox):
-    normVals = np.full(len(bbox), frame.shape[0])
-    normVals[::2] = frame.shape[1]
-    return (np.clip(np.array(bbox), 0, 1) * normVals).astype(int)
-
+def frame_sharpness(frame):
+    # Laplacian variance of a downscaled gray frame, low for blurred or dark frames
+    small = cv2.resize(frame, (160, 160), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = gray_scale_frame(small)
+    return cv2.Laplacian(small, cv2.CV_64F).var()
 
-labelMap = [
-    "down",
-    "front",
-    "step"
-]
 
+class DirectionEstimator:
+    # Direction votes of the last `history` tracked frames, each weighted by how well the points agreed
+    def __init__(self, history=15):
+        self.votes = deque(maxlen=history)
 
-def get_bbox(results, frame):
-    # Lists to store bounding boxes for escalators and steps
-    esc_bboxes = []
-    step_bboxes = []
+    def reset(self):
+        self.votes.clear()
 
-    for result in results:
-        bbox = frame_norm(frame, (result.xmin, result.ymin, result.xmax, result.ymax))
-        bbox = np.insert(bbox, 0, result.label).tolist()
-        if labelMap[result.label] == 'step':
-            # print('Step size: ',str(bbox[4]-bbox[2]),'px')
-            step_bboxes.append(bbox)
-        else:
-            esc_bboxes.append(bbox)
-
-    return esc_bboxes, step_bboxes
+    def update(self, direction, agreement):
+        self.votes.append((direction, agreement))
+        return self.estimate()
 
-
-def save_frame(frame):
-    cv2.imwrite('SavedFrame/' + str(uuid.uuid4()) + '.jpg', frame)
+    def estimate(self):
+        # confidence is the winning share of a full history, so it needs `history` frames to reach 1
+        if not self.votes:
+            return None, 0.0
+        weights = {}
+        for direction, agreement in self.votes:
+            weights[direction] = weights.get(direction, 0.0) + agreement
+        direction = max(weights, key=weights.get)
+        return direction, weights[direction] / self.votes.maxlen
 
 
 class EscalatorDetector:
 
-    def __init__(self, device: dai.Device):
+    def __init__(self, device: dai.Device, pointMode='line'):
+        # 'line': three points on the step midline, 'grid': a grid inside the step box,
+        # 'features': good features to track inside the step box
+        self.pointMode = pointMode
+        self.gridSize = (5, 4)
+        self.maxFeatures = 30
+        # dense modes: deviation from the mean direction at which a track is an outlier
+        self.outlierDeg = 45
+        # stop tracking once the direction confidence reaches this (None tracks the whole window)
+        self.confidenceThreshold = 0.8
+        self.minTrackTime = 0.5
+        self.estimator = DirectionEstimator()
+        self.confidence = 0.0
+        # dense modes: fewest tracked points for a valid answer
+        self.minPoints = 3
+
         # Lucas-Kanade for front view
         self.lk_params = dict(
             winSize=(25, 25),
@@ -81,13 +80,31 @@ class EscalatorDetector:
         self.minStepMovement = 0
         self.isFrontView = False
 
+        # frames below this sharpness are skipped while the camera settles, for at most warmUpTimeout seconds
+        self.minSharpness = 30.0
+        self.warmUpTimeout = 2
+        # the camera counts as settled if a usable frame was seen this recently
+        self.warmTime = 5
+        self.lastUsableTime = 0
+        # frames are read newest first, skipping ones older than this many seconds
+        self.maxFrameAge = 0.2
+        self.readers = {}
+        # rgb frames paired with the detections computed on them
+        self.sync = None
+        # escalators and steps seen during the search, so they need not show up in the same frame
+        self.tracker = BoxTracker()
+        # frames an escalator step was found in are saved from a background thread
+        self.frameSink = FrameSink()
+
         # boolean for return an error
         self.errorOccurs = False
         self.escExist = True
         self.oakdConnectionError = False
 
         self.startEndCoords = {'start': [], 'end': []}
-        self.missingPt = []
+        # per point flags: still being tracked / tracked at least once
+        self.trackStatus = np.zeros(0, bool)
+        self.everTracked = np.zeros(0, bool)
         self.lastFrame = None
 
         self.oldPoints = None
@@ -104,9 +121,9 @@ class EscalatorDetector:
 
     def display(self, frame):
         frameBgr = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-        for idx, p1 in enumerate(self.startEndCoords['end']):
+        for idx in np.flatnonzero(self.everTracked):
             x1, y1 = self.prevPt[idx]
-            x2, y2 = p1
+            x2, y2 = (int(v) for v in self.oldPoints[idx])
             cv2.arrowedLine(frameBgr, (x1, y1), (x2, y2), (0, 0, 255), 2, 4, 0, 5)
         frameDisplay = cv2.resize(frameBgr, (320, 320))
         cv2.imshow('result', frameDisplay)
@@ -124,12 +141,62 @@ class EscalatorDetector:
         degree = (degrees(atan2(dy, dx)) + 360) % 360
         return degree
 
+    def pointAngles(self, start, end):
+        # getAngleBtw2Points for every point at once
+        dx = end[:, 0] - start[:, 0]
+        dy = end[:, 1] - start[:, 1]
+        degree = (np.degrees(np.arctan2(dy, dx)) + 360) % 360
+        if self.isFrontView:
+            degree[np.abs(dy) < self.minStepMovement] = 0
+        return degree
+
+    def robustAngle(self, angles):
+        # circular mean, recomputed without the tracks too far from it;
+        # agreement is the inlier share times the inliers' mean resultant length
+        rad = np.radians(angles)
+        vec = np.stack([np.cos(rad), np.sin(rad)], axis=1)
+        mean = vec.mean(axis=0)
+        for _ in range(2):
+            center = np.arctan2(mean[1], mean[0])
+            deviation = np.abs((rad - center + np.pi) % (2 * np.pi) - np.pi)
+            inliers = deviation <= np.radians(self.outlierDeg)
+            if not inliers.any():
+                break
+            mean = vec[inliers].mean(axis=0)
+        agreement = float(np.hypot(mean[0], mean[1]) * np.count_nonzero(inliers) / len(angles))
+        return (degrees(atan2(mean[1], mean[0])) + 360) % 360, agreement
+
+    def trackedPoints(self):
+        start = np.array(self.startEndCoords['start'], dtype=np.float32).reshape(-1, 2)[self.everTracked]
+        return start, self.oldPoints[self.everTracked]
+
+    def updateEstimate(self):
+        # feed the direction of the current frame to the estimator
+        if not self.everTracked.any() or (self.pointMode == 'line' and not self.trackedEnough()):
+            return None, 0.0
+        angle, agreement = self.robustAngle(self.pointAngles(*self.trackedPoints()))
+        direction = self.identifyDirection() if self.pointMode == 'line' else self.ang2EscDirection(angle)
+        direction, self.confidence = self.estimator.update(direction, agreement)
+        return direction, self.confidence
+
+    def trackedEnough(self):
+        if self.pointMode == 'line':
+            return len(self.startEndCoords['end']) == len(self.startEndCoords['start'])
+        return np.count_nonzero(self.everTracked) >= self.minPoints
+
     def identifyDirection(self):
+        if self.pointMode != 'line':
+            if not self.everTracked.any():
+                return 0
+            angle, _ = self.robustAngle(self.pointAngles(*self.trackedPoints()))
+            return self.ang2EscDirection(angle)
+
+        # 'end' only holds the points LK has tracked, pair them with their own start points
+        start = [p for p, tracked in zip(self.startEndCoords['start'], self.everTracked) if tracked]
         totalDeg = 0
-        for idx, p0 in enumerate(self.startEndCoords['start']):
-            p1 = self.startEndCoords['end'][idx]
+        for p0, p1 in zip(start, self.startEndCoords['end']):
             totalDeg += self.getAngleBtw2Points(p0, p1)
-        length = len(self.startEndCoords['start'])
+        length = len(start)
         if length == 0:
             return 0
         avgDeg = totalDeg / length
@@ -155,44 +222,64 @@ class EscalatorDetector:
         self.oakdConnectionError = False
 
         self.startEndCoords = {'start': [], 'end': []}
-        self.missingPt = []
+        self.trackStatus = np.zeros(0, bool)
+        self.everTracked = np.zeros(0, bool)
+        self.estimator.reset()
+        self.confidence = 0.0
         self.minStepMovement = 0
 
-    def setStartPoints(self, objArea):
+    def setStartPoints(self, objArea, frame=None):
 
         self.prevPt = []
-        y = int(objArea[1] + (objArea[3] - objArea[1]) / 2)
-        x1 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.25)
-        x2 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.50)
-        x3 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.75)
-        self.prevPt = [(x1, y), (x2, y), (x3, y)]
-
-        for pt in self.prevPt:
-            self.startEndCoords['start'].append(pt)
-            p = np.array([pt[0], pt[1]], dtype=np.float32).reshape(1, 2)
-            self.oldPoints = np.vstack([self.oldPoints, p])
+        if self.pointMode == 'features' and frame is not None:
+            self.prevPt = self.featurePoints(objArea, frame)
+        if self.pointMode == 'grid' or (self.pointMode == 'features' and len(self.prevPt) < self.minPoints):
+            self.prevPt = self.gridPoints(objArea)
+        if self.pointMode == 'line':
+            y = int(objArea[1] + (objArea[3] - objArea[1]) / 2)
+            x1 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.25)
+            x2 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.50)
+            x3 = int(objArea[0] + (objArea[2] - objArea[0]) * 0.75)
+            self.prevPt = [(x1, y), (x2, y), (x3, y)]
+
+        self.startEndCoords['start'].extend(self.prevPt)
+        self.oldPoints = np.vstack([self.oldPoints, np.array(self.prevPt, dtype=np.float32).reshape(-1, 2)])
+        self.trackStatus = np.ones(len(self.oldPoints), bool)
+        self.everTracked = np.zeros(len(self.oldPoints), bool)
+
+    def gridPoints(self, objArea):
+        # evenly spread points, keeping away from the box border
+        xs = np.linspace(objArea[0], objArea[2], self.gridSize[0] + 2)[1:-1]
+        ys = np.linspace(objArea[1], objArea[3], self.gridSize[1] + 2)[1:-1]
+        return [(int(x), int(y)) for y in ys for x in xs]
+
+    def featurePoints(self, objArea, frame):
+        mask = np.zeros(frame.shape[:2], np.uint8)
+        mask[objArea[1]:objArea[3], objArea[0]:objArea[2]] = 255
+        corners = cv2.goodFeaturesToTrack(frame, self.maxFeatures, 0.01, 5, mask=mask)
+        if corners is None:
+            return []
+        return [(int(x), int(y)) for x, y in corners.reshape(-1, 2)]
 
     def calOpticalFlow(self, preFrame, curFrame):
-        for idx, pt in enumerate(self.oldPoints):
-            if idx not in self.missingPt:
-                # store old points for arrow line
-                self.prevPt[idx] = (int(pt[0]), int(pt[1]))
-                pt = np.array([[pt[0], pt[1]]], dtype=np.float32)
-
-                # Calculate optical flow using appropriate parameters
-                lk_params = self.lk_params if self.isFrontView else self.lk_params2
-                newPoints, status, error = cv2.calcOpticalFlowPyrLK(preFrame, curFrame, pt, None, **lk_params)
-
-                # Update point location if optical flow succeeded
-                if status[0] == 1:
-                    self.oldPoints[idx] = newPoints
-                    nX, nY = newPoints.ravel()
-                    if len(self.startEndCoords['end']) < idx + 1 or len(self.startEndCoords['end']) == 0:
-                        self.startEndCoords['end'].append((int(nX), int(nY)))
-                    else:
-                        self.startEndCoords['end'][idx] = (int(nX), int(nY))
-                else:
-                    self.missingPt.append(idx)
+        # store old points for arrow line
+        self.prevPt = [(int(x), int(y)) for x, y in self.oldPoints]
+
+        live = np.flatnonzero(self.trackStatus)
+        if len(live) == 0:
+            return
+
+        # Calculate optical flow of every live point in one call, so both pyramids are built once per frame pair
+        lk_params = self.lk_params if self.isFrontView else self.lk_params2
+        pts = self.oldPoints[live].reshape(-1, 1, 2)
+        newPoints, status, error = cv2.calcOpticalFlowPyrLK(preFrame, curFrame, pts, None, **lk_params)
+
+        # Update point locations where optical flow succeeded, stop tracking the others
+        ok = status.ravel() == 1
+        self.oldPoints[live[ok]] = newPoints.reshape(-1, 2)[ok]
+        self.trackStatus[live[~ok]] = False
+        self.everTracked[live[ok]] = True
+        self.startEndCoords['end'] = [(int(x), int(y)) for x, y in self.oldPoints[self.everTracked]]
 
     def getNewCoords(self, x, y):
         rx = 640 / 320
@@ -203,22 +290,43 @@ class EscalatorDetector:
         cv2.imshow('Last Frame', self.lastFrame)
         cv2.waitKey(0)
 
+    def skipBlurFrames(self, sync):
+        # returns the first usable (rgb, nn) pair, or None if the camera is already settled
+        if time.time() - self.lastUsableTime < self.warmTime:
+            return None
+        cur_time = time.time()
+        time_out = cur_time + self.warmUpTimeout
+        while time_out > cur_time:
+            cur_time = time.time()
+            bundle = sync.get()
+            inRgb = LazyFrame.wrap(bundle["rgb"])
+            inDet = bundle["nn"]
+            if inRgb is not None and frame_sharpness(inRgb.gray()) >= self.minSharpness:
+                self.lastUsableTime = cur_time
+                return inRgb, inDet
+        return None
+
+    def grayQueue(self):
+        # the device converts the rgb frames to gray itself when its pipeline has the gray stream
+        if "gray" not in self.device.getOutputQueueNames():
+            return None
+        return self.device.getOutputQueue(name="gray", maxSize=4, blocking=False)
+
     def detectOAKD(self):
         try:
             # Output queues will be used to get the rgb frames and nn data from the outputs defined above
             qRgb = self.device.getOutputQueue(name="rgb", maxSize=4, blocking=False)
             qDet = self.device.getOutputQueue(name="nn", maxSize=4, blocking=False)
-
-            # Get the start time of the execution time
-            self.st = time.time()
+            qGray = self.grayQueue()
+            clock = device_clock(self.device)
+            # the passthrough frame and its detections carry the same sequence number
+            self.sync = FrameSync({"rgb": qRgb, "nn": qDet}, key="seq", clock=clock)
+            self.readers = {"rgb": LatestFrameReader(qRgb, self.maxFrameAge, clock)}
+            if qGray is not None:
+                self.readers["gray"] = LatestFrameReader(qGray, self.maxFrameAge, clock)
 
             # Skip the blur frame
-            cur_time = time.time()
-            time_out = cur_time + 2
-            while time_out > cur_time:
-                cur_time = time.time()
-                qRgb.get()
-                qDet.get()
+            pending = self.skipBlurFrames(self.sync)
 
             # 3 second for finding the escalator
             cur_time = time.time()
@@ -227,27 +335,30 @@ class EscalatorDetector:
             esc_found = False
             nearest_esc = None
             frame = None
+            self.tracker.reset()
 
             while cur_time < time_out and esc_found is False:
 
                 cur_time = time.time()
 
-                inRgb = qRgb.get()
-                inDet = qDet.get()
-
-                # Lists to store bounding boxes for escalators and steps
-                esc_bboxes = []
-                step_bboxes = []
+                if pending is not None:
+                    inRgb, inDet = pending
+                    pending = None
+                else:
+                    bundle = self.sync.get()
+                    inRgb = bundle["rgb"]
+                    inDet = bundle["nn"]
 
+                # the pixels are only converted once a step is found, the boxes need just the size
                 if inRgb is not None:
-                    frame = inRgb.getCvFrame()
-                    # self.display_2(frame)
+                    frame = LazyFrame.wrap(inRgb)
+                    # self.display_2(frame.bgr())
                 else:
                     self.errorOccurs = True
                     return
 
                 if inDet is not None:
-                    esc_bboxes, step_bboxes = get_bbox(inDet.detections, frame)
+                    boxes = detection_boxes(inDet.detections, frame.shape)
                 else:
                     self.errorOccurs = True
                     return
@@ -255,34 +366,16 @@ class EscalatorDetector:
                 nearest_esc = None
                 esc_found = False
 
-                if esc_bboxes:
-                    # Find the nearest escalator
-                    min_dst = float('inf')
-
-                    # Center point of frame
-                    cx = int(frame.shape[1] / 2)
-                    cy = int(frame.shape[0] / 2)
-
-                    for esc in esc_bboxes:
-                        # Center point of bounding box
-                        ecx = int((esc[1] + esc[3]) / 2)
-                        ecy = int((esc[2] + esc[4]) / 2)
-                        esc_dst = math.sqrt((cx - ecx) ** 2 + (cy - ecy) ** 2)
-
-                        if esc_dst < min_dst:
-                            min_dst = esc_dst
-                            nearest_esc = esc
-
-                    # Checking overlapping for step and escalator
-                    if nearest_esc:
-                        for step in step_bboxes:
-                            if is_boxes_overlap(nearest_esc[1:], step[1:]):
-                                # print('Step found')
-                                nearest_esc[1:] = step[1:]
-                                nearest_esc.append(frame)
-                                save_frame(frame)
-                                esc_found = True
-                                break
+                # the nearest escalator to the frame center, tracked from the first step box overlapping it;
+                # both may come from the last few frames
+                self.tracker.update(boxes)
+                found = nearest_escalator_step(self.tracker.confident(), frame.shape)
+                if found is not None:
+                    # print('Step found')
+                    label, step = found
+                    nearest_esc = [label] + step + [frame]
+                    self.frameSink.put(frame)
+                    esc_found = True
 
             if esc_found and nearest_esc is not None:
                 self.oldPoints = np.empty((0), np.float32).reshape(0, 2)
@@ -294,38 +387,56 @@ class EscalatorDetector:
                     # print('Down view Escalator')
                     self.isFrontView = False
 
-                self.setStartPoints(nearest_esc[1:-1])
+                prev_frame = nearest_esc[-1].gray()
+                # gray frames the device sent after the one the step was found in
+                grayBacklog = deque()
+                if qGray is not None:
+                    foundSeq = nearest_esc[-1].getSequenceNum()
+                    grayBacklog.extend(msg for msg in qGray.tryGetAll() if msg.getSequenceNum() > foundSeq)
+                self.setStartPoints(nearest_esc[1:-1], prev_frame)
 
                 # print('Start')
                 self.minStepMovement = int((nearest_esc[4] - nearest_esc[2]) * 0.15)
                 # print('Min: ', self.minStepMovement)
-                prev_frame = gray_scale_frame(nearest_esc[-1])
 
                 cur_time_2 = time.time()
                 time_out_2 = cur_time + 3
+                track_start = cur_time_2
 
                 while True:
                     cur_time_2 = time.time()
 
-                    inRgb = qRgb.get()
+                    if qGray is None:
+                        inFrame = self.readers["rgb"].get()
+                    elif grayBacklog:
+                        inFrame = grayBacklog.popleft()
+                    else:
+                        inFrame = self.readers["gray"].get()
 
-                    if inRgb is not None:
-                        frame = inRgb.getCvFrame()
+                    if inFrame is not None:
+                        frame = LazyFrame.wrap(inFrame).gray()
                     else:
                         self.errorOccurs = True
                         return
 
-                    frame = gray_scale_frame(frame)
                     self.calOpticalFlow(prev_frame, frame)
                     prev_frame = frame
                     # self.display(frame)
 
+                    # finish as soon as the direction is confident, a standing escalator needs the whole window
+                    escDir, confidence = self.updateEstimate()
+                    if self.confidenceThreshold is not None and escDir != '電梯靜止' \
+                            and confidence >= self.confidenceThreshold and cur_time_2 - track_start >= self.minTrackTime:
+                        self.lastFrame = frame
+                        break
+
                     key = cv2.waitKey(1)
 
                     if key == 27 or cur_time_2 > time_out_2:
                         self.lastFrame = frame
                         break
                 cv2.destroyAllWindows()
+                self.lastUsableTime = time.time()
             else:
                 self.escExist = False
                 return
@@ -338,28 +449,40 @@ class EscalatorDetector:
         cv2.imshow('Last Frame', self.lastFrame)
         cv2.waitKey(0)
 
+    def frameSummary(self):
+        summaries = [name + ": " + reader.summary() for name, reader in self.readers.items()]
+        if self.sync is not None:
+            summaries.insert(0, "rgb/nn: " + self.sync.summary())
+        return "; ".join(summaries)
+
+    def runStats(self):
+        return {'elapsed': time.time() - self.st, 'confidence': self.confidence}
+
+    # returns (status, message, {'elapsed': seconds, 'confidence': 0..1})
     def run(self):
 
+        # Get the start time of the execution time
+        self.st = time.time()
+
         if self.device is None or self.pipelineError:
-            return False, 'pipeline error'
+            return False, 'pipeline error', self.runStats()
 
         self.detectOAKD()
 
-        if self.errorOccurs or len(self.startEndCoords['end']) != len(self.startEndCoords['start']):
+        if self.errorOccurs or (self.escExist and not self.trackedEnough()):
+            stats = self.runStats()
             self.initialSetting()
-            return False, 'Could not get first frame from camera.'
+            return False, 'Could not get first frame from camera.', stats
 
         if not self.escExist:
+            stats = self.runStats()
             self.initialSetting()
-            return True, '找不到電梯'
+            return True, '找不到電梯', stats
 
         escDir = self.identifyDirection()
+        stats = self.runStats()
         self.initialSetting()
 
-        # get the end time
-        et = time.time()
-        # get the execution time
-        elapsed_time = et - self.st
-        print('Execution time:', int(elapsed_time), 'seconds')
+        print('Execution time: %.2f seconds, confidence %.2f' % (stats['elapsed'], stats['confidence']))
 
-        return True, escDir
+        return True, escDir, stats
@@ -0,0 +1,435 @@
+import ctypes
+import multiprocessing
+import queue as queueLib
+import threading
+import time
+from collections import deque
+
+from EscDetect import EscalatorDetector as eDetector
+from FrameReader import device_clock
+from ObsDetect import DirectionVoter, ObsDetect as oDetector
+from SharedFrames import ProcessDevice, SharedFrameOutlet
+
+
+# Device streams each detector worker reads
+WORKER_STREAMS = {
+    "obstacle": ("disparity",),
+    "escalator": ("rgb", "nn"),
+}
+# Streams a worker also reads when the pipeline has them
+OPTIONAL_STREAMS = {
+    "obstacle": (),
+    "escalator": ("gray",),
+}
+
+
+# Longest acceptable time from resuming a stream to its first frame on the host
+MODE_SWITCH_BUDGET = 0.3
+
+
+class ResultCache:
+    # Latest result per name, stamped with the time it was produced
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.results = {}
+
+    def put(self, name, value):
+        with self.cond:
+            self.results[name] = (time.time(), value)
+            self.cond.notify_all()
+
+    def get(self, name, maxAge=None):
+        with self.cond:
+            result = self.results.get(name)
+        if result is not None and maxAge is not None and time.time() - result[0] > maxAge:
+            return None
+        return result
+
+    def wait(self, name, after=0, timeout=None):
+        # first result stamped later than `after`, or None on timeout
+        with self.cond:
+            self.cond.wait_for(lambda: name in self.results and self.results[name][0] > after, timeout)
+            result = self.results.get(name)
+        if result is None or result[0] <= after:
+            return None
+        return result
+
+
+class EngineQueue:
+    # Same get / tryGet / tryGetAll interface as a non-blocking device output queue
+    def __init__(self, engine, maxSize):
+        self.engine = engine
+        self.messages = deque(maxlen=maxSize)
+        self.cond = threading.Condition()
+
+    def push(self, msg):
+        with self.cond:
+            self.messages.append(msg)
+            self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def clear(self):
+        with self.cond:
+            self.messages.clear()
+
+    def tryGet(self):
+        with self.cond:
+            if not self.engine.running:
+                raise RuntimeError("Frame engine stopped")
+            return self.messages.popleft() if self.messages else None
+
+    def get(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.messages or not self.engine.running)
+            if not self.messages:
+                raise RuntimeError("Frame engine stopped")
+            return self.messages.popleft()
+
+    def tryGetAll(self):
+        with self.cond:
+            if not self.engine.running:
+                raise RuntimeError("Frame engine stopped")
+            msgs = list(self.messages)
+            self.messages.clear()
+            return msgs
+
+    def has(self):
+        with self.cond:
+            return len(self.messages) > 0
+
+
+class EngineView:
+    # Device stand-in handed to one consumer, each stream it asks for gets its own copy of the frames
+    def __init__(self, engine):
+        self.engine = engine
+        self.queues = {}
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        if name not in self.queues:
+            self.queues[name] = self.engine.subscribe(name, maxSize)
+        return self.queues[name]
+
+    def getOutputQueueNames(self):
+        return self.engine.device.getOutputQueueNames()
+
+    def clock(self):
+        clock = device_clock(self.engine.device)
+        return clock() if clock is not None else None
+
+    def isClosed(self):
+        return not self.engine.running
+
+
+class FrameEngine:
+    # One per device: pulls the device queues continuously, runs the detectors on them
+    # and keeps their latest results in a ResultCache for the services to read.
+    # With processes=True each detector runs in its own process, out of the GIL of the process that
+    # keeps Bluetooth and the services: frames reach it through shared memory and only results come back.
+    def __init__(self, device, processes=False):
+        self.device = device
+        self.processes = processes
+        self.results = ResultCache()
+        self.running = False
+        self.lock = threading.Lock()
+        self.deviceQueues = {}
+        self.subscribers = {}
+        self.threads = []
+        self.context = multiprocessing.get_context("spawn") if processes else None
+        self.workers = []
+        self.outlets = []
+        # the pump always runs, each detector only while a service wants its result
+        self.active = {name: self.context.Event() if processes else threading.Event()
+                       for name in WORKER_STREAMS}
+        # bumped whenever a worker is activated or one of its streams pauses or resumes,
+        # a result the worker started on before the bump is stale
+        self.epochs = {name: self.context.RawValue("l", 0) if processes else ctypes.c_long(0)
+                       for name in WORKER_STREAMS}
+        # ObsDetect.OCCUPANCY_PRESETS entry the obstacle worker uses, and how old its disparity frames may be in seconds
+        self.obstaclePreset = "legacy"
+        self.obstacleMaxFrameAge = 0.15
+        # streams the pump leaves alone, and when each resumed stream was asked for
+        self.paused = set()
+        self.resumedAt = {}
+        self.switchLatency = {}
+
+    def pauseStream(self, name):
+        with self.lock:
+            if name not in self.paused:
+                self.bumpEpochs(name)
+            self.paused.add(name)
+            self.resumedAt.pop(name, None)
+            deviceQueue = self.deviceQueues.get(name)
+            subs = list(self.subscribers.get(name, []))
+        # frames of a paused stream are not kept around
+        if deviceQueue is not None and self.running:
+            try:
+                deviceQueue.tryGetAll()
+            except RuntimeError:
+                # the device is gone, the pump notices it too
+                pass
+        for queue in subs:
+            queue.clear()
+
+    def resumeStream(self, name):
+        with self.lock:
+            if name in self.paused:
+                self.paused.discard(name)
+                self.resumedAt[name] = time.time()
+                self.bumpEpochs(name)
+
+    def bumpEpochs(self, stream):
+        for worker, streams in WORKER_STREAMS.items():
+            if stream in streams + OPTIONAL_STREAMS[worker]:
+                self.epochs[worker].value += 1
+
+    def setActive(self, name, active):
+        if active:
+            with self.lock:
+                self.epochs[name].value += 1
+            self.active[name].set()
+        else:
+            self.active[name].clear()
+
+    def subscribe(self, name, maxSize=4):
+        queue = EngineQueue(self, maxSize)
+        with self.lock:
+            if name not in self.deviceQueues:
+                self.deviceQueues[name] = self.device.getOutputQueue(name=name, maxSize=4, blocking=False)
+                self.subscribers[name] = []
+            self.subscribers[name].append(queue)
+        return queue
+
+    def view(self):
+        return EngineView(self)
+
+    def availableWorkers(self):
+        # workers whose streams the device pipeline has, depending on its profile
+        if not hasattr(self.device, "getOutputQueueNames"):
+            return list(WORKER_STREAMS)
+        names = set(self.device.getOutputQueueNames())
+        return [worker for worker, streams in WORKER_STREAMS.items() if names.issuperset(streams)]
+
+    def workerOptions(self, worker):
+        if worker == "obstacle":
+            return {"preset": self.obstaclePreset, "maxFrameAge": self.obstacleMaxFrameAge}
+        return {}
+
+    def start(self):
+        self.running = True
+        targets = [self._pump]
+        if self.processes:
+            self.startProcesses()
+            targets.append(self._collect)
+        else:
+            for worker in self.availableWorkers():
+                targets.append(lambda worker=worker: WORKER_LOOPS[worker](
+                    self.view(), self.active[worker], self.results.put, lambda: self.running,
+                    lambda: self.epochs[worker].value, **self.workerOptions(worker)))
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def startProcesses(self):
+        names = self.device.getOutputQueueNames()
+        clock = device_clock(self.device)
+        # the workers rebuild the device clock from time.monotonic(), which the clock is synced to
+        clockSpec = None
+        if clock is not None:
+            rate = getattr(self.device, "speed", 1.0)
+            clockSpec = (clock().total_seconds() - time.monotonic() * rate, rate)
+        self.resultQueue = self.context.Queue()
+        self.stopping = self.context.Event()
+        for worker in self.availableWorkers():
+            inbox = self.context.Queue()
+            streams = WORKER_STREAMS[worker] + tuple(n for n in OPTIONAL_STREAMS[worker] if n in names)
+            for name in streams:
+                outlet = SharedFrameOutlet(inbox, name)
+                with self.lock:
+                    if name not in self.deviceQueues:
+                        self.deviceQueues[name] = self.device.getOutputQueue(name=name, maxSize=4, blocking=False)
+                        self.subscribers[name] = []
+                    self.subscribers[name].append(outlet)
+                self.outlets.append(outlet)
+            process = self.context.Process(
+                target=worker_process, daemon=True,
+                args=(worker, inbox, self.resultQueue, self.active[worker], self.epochs[worker], self.stopping,
+                      streams, clockSpec, self.workerOptions(worker)))
+            process.start()
+            self.workers.append((process, inbox))
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            queues = [queue for subs in self.subscribers.values() for queue in subs]
+        for queue in queues:
+            queue.wake()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=5)
+        self.threads = []
+        if self.processes:
+            self.stopProcesses()
+
+    def stopProcesses(self):
+        self.stopping.set()
+        for process, inbox in self.workers:
+            inbox.put(None)
+        for process, inbox in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            inbox.cancel_join_thread()
+            inbox.close()
+        # the rings are unlinked only once no worker can still attach to them
+        for outlet in self.outlets:
+            outlet.close()
+        self.workers = []
+        self.outlets = []
+
+    def _collect(self):
+        # results of the worker processes into the ResultCache
+        while self.running:
+            try:
+                name, value = self.resultQueue.get(timeout=0.1)
+            except queueLib.Empty:
+                continue
+            self.results.put(name, value)
+
+    def _pump(self):
+        try:
+            while self.running:
+                with self.lock:
+                    streams = [(name, self.deviceQueues[name], list(self.subscribers[name]))
+                               for name in self.deviceQueues if name not in self.paused]
+                received = 0
+                for name, deviceQueue, subs in streams:
+                    msgs = deviceQueue.tryGetAll()
+                    if msgs and name in self.resumedAt:
+                        self.logResume(name)
+                    for msg in msgs:
+                        received += 1
+                        for queue in subs:
+                            queue.push(msg)
+                if received == 0:
+                    time.sleep(0.001)
+        except RuntimeError as e:
+            print("Frame engine: device queues closed,", e)
+        self.running = False
+        with self.lock:
+            queues = [queue for subs in self.subscribers.values() for queue in subs]
+        for queue in queues:
+            queue.wake()
+
+    def logResume(self, name):
+        with self.lock:
+            resumedAt = self.resumedAt.pop(name, None)
+        if resumedAt is None:
+            return
+        latency = time.time() - resumedAt
+        self.switchLatency[name] = latency
+        print("Stream %s resumed in %.3f seconds" % (name, latency))
+        if latency > MODE_SWITCH_BUDGET:
+            print("Stream %s went over the %.3f s mode switch budget" % (name, MODE_SWITCH_BUDGET))
+
+
+def obstacle_worker(device, active, publish, running, epoch, preset="legacy", maxFrameAge=0.15):
+    # a new direction is published as soon as the vote settles on it, an unchanged one once per second;
+    # epoch() changes when the worker is activated or its stream paused or resumed
+    REFRESH_TIME = 1
+    MIN_CONFIDENCE = 0.6
+    MIN_VOTES = 5
+    try:
+        detector = oDetector(device, preset, maxFrameAge)
+        voter = DirectionVoter()
+        published = None
+        publishedAt = 0
+        idle = True
+        seen = None
+        while running():
+            if not active.wait(0.1):
+                if not idle:
+                    print("Obstacle frames:", detector.reader.summary())
+                    publish("obstacle.frames", detector.reader.stats())
+                idle = True
+                continue
+            if idle or epoch() != seen:
+                # drop frames that queued up while idle or paused, and the votes from before
+                seen = epoch()
+                detector.queue.tryGetAll()
+                voter.reset()
+                published = None
+                idle = False
+            direction = []
+            detector.get_guide(list_dir=direction, display=False)
+            if epoch() != seen:
+                # the frame may be from before a pause
+                continue
+            code, confidence = voter.update(direction[0])
+            cur_time = time.time()
+            if voter.count < MIN_VOTES or confidence < MIN_CONFIDENCE:
+                continue
+            if code != published or cur_time - publishedAt >= REFRESH_TIME:
+                publish("obstacle", (code, detector.get_direct_msg(code)))
+                published = code
+                publishedAt = cur_time
+    except RuntimeError:
+        pass
+
+
+def escalator_worker(device, active, publish, running, epoch):
+    detector = eDetector(device, pointMode='grid')
+    try:
+        while running():
+            if not active.wait(0.1):
+                continue
+            started = epoch()
+            status, msg, stats = detector.run()
+            if detector.pipelineError:
+                break
+            if epoch() != started:
+                # a run that waited through a pause tracked frames from before it
+                continue
+            publish("escalator", (status, msg, stats))
+    finally:
+        detector.frameSink.close()
+
+
+WORKER_LOOPS = {
+    "obstacle": obstacle_worker,
+    "escalator": escalator_worker,
+}
+
+
+class ProcessActive:
+    # The worker's view of its mp.Event: while idle it keeps emptying the inbox into the bounded
+    # stream queues, as the engine's pump does for an idle worker thread
+    def __init__(self, event, device):
+        self.event = event
+        self.device = device
+
+    def wait(self, timeout):
+        if self.event.wait(timeout):
+            return True
+        try:
+            self.device.poll(0)
+        except RuntimeError:
+            pass
+        return False
+
+
+def worker_process(worker, inbox, resultQueue, active, epoch, stopping, names, clockSpec, options):
+    device = ProcessDevice(inbox, names, clockSpec, stopping)
+    resultQueue.put((worker + ".ready", True))
+    try:
+        WORKER_LOOPS[worker](device, ProcessActive(active, device), lambda name, value: resultQueue.put((name, value)),
+                             lambda: not stopping.is_set(), lambda: epoch.value, **options)
+    except (RuntimeError, KeyboardInterrupt):
+        pass
+    finally:
+        if device.overwritten:
+            print("Worker %s: %d frames overwritten before they were read" % (worker, device.overwritten))
+        device.close()
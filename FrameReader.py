@@ -0,0 +1,137 @@
+from collections import deque
+
+import depthai as dai
+import numpy as np
+
+
+def device_clock(device):
+    # host clock the device timestamps are synced to, None when frames carry no real time (fast replay)
+    clock = getattr(device, "clock", None)
+    if clock is None:
+        return dai.Clock.now
+    return clock if clock() is not None else None
+
+
+class LatestFrameReader:
+    # Reads a non-blocking output queue newest first: older queued frames are dropped, and a frame
+    # older than maxAge seconds is skipped while a fresher one can still be waited for.
+    # Without a clock every frame is returned in order, as queue.get() would.
+    def __init__(self, queue, maxAge=None, clock=None, history=100):
+        self.queue = queue
+        self.maxAge = maxAge
+        self.clock = clock
+        self.frames = 0
+        self.dropped = 0
+        self.stale = 0
+        # age in seconds of the last returned frames
+        self.ages = deque(maxlen=history)
+
+    def age(self, msg):
+        return (self.clock() - msg.getTimestamp()).total_seconds()
+
+    def get(self):
+        if self.clock is None:
+            msg = self.queue.get()
+            self.frames += 1
+            return msg
+        while True:
+            msgs = self.queue.tryGetAll()
+            waited = not msgs
+            if waited:
+                msgs = [self.queue.get()]
+            self.dropped += len(msgs) - 1
+            msg = msgs[-1]
+            age = self.age(msg)
+            # a frame that just arrived is the freshest there is, even over budget
+            if self.maxAge is not None and age > self.maxAge and not waited:
+                self.stale += 1
+                continue
+            self.frames += 1
+            self.ages.append(age)
+            return msg
+
+    def drain(self):
+        # forget what queued up, e.g. while the consumer was idle
+        self.queue.tryGetAll()
+
+    def stats(self):
+        ages = np.array(self.ages) if self.ages else np.zeros(1)
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "stale": self.stale,
+            "meanAge": float(ages.mean()),
+            "p95Age": float(np.percentile(ages, 95)),
+            "maxAge": float(ages.max()),
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return "%d frames, %d dropped, %d stale, age mean %.0f ms, p95 %.0f ms, max %.0f ms" % (
+            stats["frames"], stats["dropped"], stats["stale"],
+            stats["meanAge"] * 1000, stats["p95Age"] * 1000, stats["maxAge"] * 1000)
+
+
+class FrameSync:
+    # Matches the messages of several streams by sequence number (key "seq") or by timestamp within
+    # `tolerance` seconds (key "ts", for streams from different cameras such as rgb and disparity)
+    # and returns them as {name: msg} bundles, newest match first. Messages older than a returned
+    # bundle can never match any more and are dropped; at most maxPending wait per stream.
+    # Like LatestFrameReader, without a clock the queues are read in order instead of drained.
+    def __init__(self, queues, key="seq", tolerance=0.02, maxPending=8, clock=None):
+        self.queues = queues
+        self.key = key
+        self.tolerance = tolerance if key == "ts" else 0
+        self.maxPending = maxPending
+        self.clock = clock
+        # name -> deque of (key, msg), oldest first
+        self.buffers = {name: deque() for name in queues}
+        self.bundles = 0
+        self.dropped = 0
+
+    def keyOf(self, msg):
+        if self.key == "seq":
+            return msg.getSequenceNum()
+        return msg.getTimestamp().total_seconds()
+
+    def add(self, name, msg):
+        buffer = self.buffers[name]
+        if len(buffer) >= self.maxPending:
+            buffer.popleft()
+            self.dropped += 1
+        buffer.append((self.keyOf(msg), msg))
+
+    def match(self):
+        names = list(self.buffers)
+        for key, msg in reversed(self.buffers[names[0]]):
+            bundle = {names[0]: (key, msg)}
+            for name in names[1:]:
+                nearest = min(self.buffers[name], key=lambda entry: abs(entry[0] - key), default=None)
+                if nearest is None or abs(nearest[0] - key) > self.tolerance:
+                    break
+                bundle[name] = nearest
+            else:
+                for name, (matchKey, matchMsg) in bundle.items():
+                    buffer = self.buffers[name]
+                    while buffer and buffer[0][0] <= matchKey:
+                        if buffer.popleft()[1] is not matchMsg:
+                            self.dropped += 1
+                self.bundles += 1
+                return {name: entry[1] for name, entry in bundle.items()}
+        return None
+
+    def get(self):
+        while True:
+            if self.clock is not None:
+                for name, queue in self.queues.items():
+                    for msg in queue.tryGetAll():
+                        self.add(name, msg)
+            bundle = self.match()
+            if bundle is not None:
+                return bundle
+            # wait for the stream that is furthest behind
+            name = min(self.buffers, key=lambda n: self.buffers[n][-1][0] if self.buffers[n] else float("-inf"))
+            self.add(name, self.queues[name].get())
+
+    def summary(self):
+        return "%d bundles, %d dropped" % (self.bundles, self.dropped)
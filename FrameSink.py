@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+
+import cv2
+
+from FrameStore import FrameStore
+from SessionReplay import STREAM_KINDS
+
+
+class FrameSink:
+    # Saves frames from a background thread so the detectors never wait on the SD card.
+    # format "jpg" writes one JPEG per frame, "session" appends the raw frames to a recorded session
+    # (an rgb-only SessionReplay directory) that ReplayDevice can play back.
+    # Frames may be arrays or LazyFrames, which are only converted on the writer thread.
+    def __init__(self, directory="SavedFrame", format="jpg", maxPending=8, dropOldest=True, sampleEvery=1,
+                 maxFiles=500, maxBytes=200 * 1024 * 1024, maxAge=7 * 24 * 3600):
+        self.directory = directory
+        self.format = format
+        self.dropOldest = dropOldest
+        # keep one frame out of every sampleEvery offered
+        self.sampleEvery = sampleEvery
+        # retention of the entries (JPEGs or session directories) in the directory
+        self.maxFiles = maxFiles
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.pending = deque(maxlen=maxPending)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.session = None
+        self.offered = 0
+        self.written = 0
+        self.dropped = 0
+        self.deleted = 0
+
+    def put(self, frame, ts=None, seq=None):
+        # never blocks, returns False if the frame was sampled out or dropped
+        self.offered += 1
+        if (self.offered - 1) % self.sampleEvery:
+            return False
+        if ts is None:
+            ts = frame.getTimestamp().total_seconds() if hasattr(frame, "getTimestamp") else time.time()
+        if seq is None:
+            seq = frame.getSequenceNum() if hasattr(frame, "getSequenceNum") else self.offered
+        with self.cond:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+                if not self.dropOldest:
+                    return False
+            self.pending.append((frame, ts, seq))
+            self.start()
+            self.cond.notify()
+        return True
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.running = True
+            self.thread = threading.Thread(target=self._write, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        # writes what is still pending, then closes the session files
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+            self.thread = None
+
+    def _write(self):
+        # a failing SD card costs the frames it fails on, never the writer thread
+        self.guarded("prepare the directory", self.prepare)
+        attempts = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or not self.running)
+                if not self.pending:
+                    break
+                frame, ts, seq = self.pending.popleft()
+            if self.guarded("save a frame", self.writeFrame, frame, ts, seq):
+                self.written += 1
+            attempts += 1
+            if attempts % 20 == 0:
+                self.guarded("enforce retention", self.enforceRetention)
+        self.guarded("close the session", self.closeSession)
+
+    def guarded(self, what, func, *args):
+        try:
+            func(*args)
+            return True
+        except (OSError, ValueError, cv2.error) as e:
+            print("Frame sink: failed to %s," % what, e)
+            return False
+
+    def prepare(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.enforceRetention()
+
+    def writeFrame(self, frame, ts, seq):
+        if hasattr(frame, "bgr"):
+            frame = frame.bgr()
+        if self.format == "jpg":
+            path = os.path.join(self.directory, str(uuid.uuid4()) + '.jpg')
+            if not cv2.imwrite(path, frame):
+                raise OSError("could not write " + path)
+            return
+        if self.session is None:
+            path = os.path.join(self.directory, time.strftime("session-%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6])
+            os.makedirs(path)
+            self.session = (path, FrameStore.create(os.path.join(path, "rgb")))
+        self.session[1].append(frame, ts, seq)
+
+    def closeSession(self):
+        if self.session is None:
+            return
+        path, store = self.session
+        store.close()
+        with open(os.path.join(path, "session.json"), "w") as f:
+            json.dump({"version": 2, "streams": {"rgb": STREAM_KINDS["rgb"]}}, f, indent=4)
+        self.session = None
+
+    def enforceRetention(self):
+        # oldest first: whatever is past maxAge, then until maxFiles and maxBytes hold
+        current = self.session[0] if self.session is not None else None
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == current:
+                continue
+            try:
+                entries.append((os.path.getmtime(path), entrySize(path), path))
+            except FileNotFoundError:
+                # deleted meanwhile
+                continue
+        entries.sort()
+        count = len(entries)
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if now - mtime <= self.maxAge and count <= self.maxFiles and total <= self.maxBytes:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            count -= 1
+            total -= size
+            self.deleted += 1
+
+    def summary(self):
+        return "%d written, %d dropped, %d deleted of %d offered" % (
+            self.written, self.dropped, self.deleted, self.offered)
+
+
+def entrySize(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
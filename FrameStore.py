@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+
+index_dtype = np.dtype([
+    ("ts", np.float64),
+    ("seq", np.int64),
+])
+
+
+class FrameStore:
+    # Fixed-shape frames kept back to back in <path>.frames, with the
+    # timestamp / sequence number index in <path>.index.npy and the layout in <path>.json
+    def __init__(self, path, frames, index):
+        self.path = path
+        self.frames = frames
+        self.index = index
+
+    @classmethod
+    def open(cls, path):
+        with open(path + ".json") as f:
+            header = json.load(f)
+        shape = tuple(header["shape"])
+        count = header["count"]
+        index = np.load(path + ".index.npy")
+        if count == 0:
+            frames = np.empty((0,) + shape, dtype=header["dtype"])
+        else:
+            # copy-on-write so callers may draw on a frame without touching the file
+            frames = np.memmap(path + ".frames", dtype=header["dtype"], mode="c", shape=(count,) + shape)
+            frames = frames.view(np.ndarray)
+        return cls(path, frames, index)
+
+    @classmethod
+    def create(cls, path):
+        return FrameStoreWriter(path)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def ts(self):
+        return self.index["ts"]
+
+    @property
+    def seq(self):
+        return self.index["seq"]
+
+    def frame(self, idx):
+        # zero-copy view into the mapped file
+        return self.frames[idx]
+
+    def find(self, ts):
+        # index of the last frame recorded at or before ts
+        return int(np.searchsorted(self.index["ts"], ts, side="right")) - 1
+
+
+class FrameStoreWriter:
+    def __init__(self, path):
+        self.path = path
+        self.shape = None
+        self.dtype = None
+        self.file = open(path + ".frames", "wb")
+        self.index = []
+
+    def append(self, frame, ts, seq):
+        frame = np.ascontiguousarray(frame)
+        if self.shape is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+        elif frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError("Frame %s %s does not match store layout %s %s" %
+                             (frame.shape, frame.dtype, self.shape, self.dtype))
+        self.file.write(frame.data)
+        self.index.append((ts, seq))
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        np.save(self.path + ".index.npy", np.array(self.index, dtype=index_dtype))
+        header = {
+            "shape": list(self.shape or ()),
+            "dtype": str(self.dtype or np.dtype(np.uint8)),
+            "count": len(self.index),
+        }
+        with open(self.path + ".json", "w") as f:
+            json.dump(header, f, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
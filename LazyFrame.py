@@ -0,0 +1,64 @@
+import cv2
+import depthai as dai
+
+
+# frame types whose data already is a single channel image
+SINGLE_CHANNEL_TYPES = (dai.ImgFrame.Type.GRAY8, dai.ImgFrame.Type.RAW8)
+
+
+class LazyFrame:
+    # Wraps an ImgFrame (or a replayed frame) and converts its pixels only when asked,
+    # each conversion at most once. The size is known without touching the pixels.
+    def __init__(self, msg):
+        self.msg = msg
+        self._bgr = None
+        self._gray = None
+        self._raw = None
+
+    @classmethod
+    def wrap(cls, msg):
+        if msg is None or isinstance(msg, cls):
+            return msg
+        return cls(msg)
+
+    @property
+    def shape(self):
+        # (height, width, channels) of the BGR frame, enough for detection boxes and box centers
+        if hasattr(self.msg, "getWidth"):
+            return self.msg.getHeight(), self.msg.getWidth(), 3
+        return self.bgr().shape
+
+    def isSingleChannel(self):
+        if hasattr(self.msg, "getType"):
+            return self.msg.getType() in SINGLE_CHANNEL_TYPES
+        return self.raw().ndim == 2
+
+    def raw(self):
+        # the data as sent, for disparity and on-device gray frames this needs no conversion
+        if self._raw is None:
+            self._raw = self.msg.getFrame()
+        return self._raw
+
+    def bgr(self):
+        if self._bgr is None:
+            self._bgr = self.msg.getCvFrame()
+        return self._bgr
+
+    def gray(self):
+        if self._gray is None:
+            if self.isSingleChannel():
+                self._gray = self.raw()
+            else:
+                self._gray = cv2.cvtColor(self.bgr(), cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def roi(self, rect):
+        # (x1, y1, x2, y2) view of the raw data, no copy
+        x1, y1, x2, y2 = rect
+        return self.raw()[y1:y2, x1:x2]
+
+    def getTimestamp(self):
+        return self.msg.getTimestamp()
+
+    def getSequenceNum(self):
+        return self.msg.getSequenceNum()
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import Counter
+
+# How often each result action may reach the phone:
+# minInterval: seconds between two sends, anything newer in between is coalesced into one pending message,
+# repeat: seconds before an unchanged message is sent again
+NOTIFY_POLICIES = {
+    "obstacle detection": {"minInterval": 1.0, "repeat": 4.0},
+    "elevator direction": {"minInterval": 1.0, "repeat": 6.0},
+}
+# Messages that skip the rate limit and drop whatever lower priority message is pending, default 0
+MESSAGE_PRIORITIES = {
+    "前方不便前行": 1,
+}
+
+
+class Notifier:
+    # Sits between the services and BluetoothServer.sendResponse, runs on the session's event loop.
+    # Actions without a policy (switch mode, hello) go straight through.
+    def __init__(self, blue_server):
+        self.btServer = blue_server
+        self.lastMessage = {}
+        self.lastSentAt = {}
+        # action -> (message, priority) waiting for its rate limit
+        self.pending = {}
+        self.timers = {}
+        # (action, outcome) -> count, outcome is sent, suppressed, coalesced or preempted
+        self.counters = Counter()
+
+    def reset(self):
+        # after a mode switch the first result of the new mode always goes out
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+        self.pending = {}
+        self.lastMessage = {}
+        self.lastSentAt = {}
+
+    def notify(self, action, message):
+        policy = NOTIFY_POLICIES.get(action)
+        if policy is None:
+            self.btServer.sendResponse(action, message)
+            return
+        now = time.time()
+        priority = MESSAGE_PRIORITIES.get(message, 0)
+        if priority > 0:
+            self.preempt(priority)
+        if message == self.lastMessage.get(action) and now - self.lastSentAt[action] < policy["repeat"]:
+            # back to what the phone last heard, nothing pending needs to go out either
+            if self.dropPending(action):
+                self.counters[(action, "coalesced")] += 1
+            self.counters[(action, "suppressed")] += 1
+            return
+        wait = self.lastSentAt.get(action, 0) + policy["minInterval"] - now
+        if wait <= 0 or priority > 0:
+            self.dropPending(action)
+            self.send(action, message, now)
+            return
+        if action in self.pending:
+            self.counters[(action, "coalesced")] += 1
+        self.pending[action] = (message, priority)
+        if action not in self.timers:
+            self.timers[action] = asyncio.get_running_loop().call_later(wait, self.flush, action)
+
+    def preempt(self, priority):
+        for action, (message, pendingPriority) in list(self.pending.items()):
+            if pendingPriority < priority:
+                self.dropPending(action)
+                self.counters[(action, "preempted")] += 1
+
+    def dropPending(self, action):
+        timer = self.timers.pop(action, None)
+        if timer is not None:
+            timer.cancel()
+        return self.pending.pop(action, None) is not None
+
+    def flush(self, action):
+        self.timers.pop(action, None)
+        pending = self.pending.pop(action, None)
+        if pending is not None:
+            self.send(action, pending[0], time.time())
+
+    def send(self, action, message, now):
+        self.lastMessage[action] = message
+        self.lastSentAt[action] = now
+        self.counters[(action, "sent")] += 1
+        self.btServer.sendResponse(action, message)
+
+    def summary(self):
+        return ", ".join("%s %s: %d" % (action, outcome, count)
+                         for (action, outcome), count in sorted(self.counters.items()))
@@ -4,40 +4,169 @@ import depthai as dai
 from collections import Counter
 import time
 
+from FrameReader import LatestFrameReader, device_clock
+
 x_loc = 100
 y_loc = 60
 thickness = 1
 
+# Occupancy map settings of get_guide:
+# cell: cell size in pixels, reduce: how a cell becomes one disparity ("sample" takes its top-left pixel,
+# "max" the nearest pixel, "percentile" the given percentile of its pixels),
+# band_edges: upper bounds of the reversed (190 - disparity) distance bands, band 1 and 2 are collisions,
+# band 3 and 4 steer, sector_edges: x-coordinates splitting the frame into steering sectors
+# (first is left, last is right, the ones between are forward),
+# collision: band 1 / band 2 cells that mean blocked, threshold: cells a sector takes before it is avoided
+OCCUPANCY_PRESETS = {
+    # the original 20 px sampling grid with four 100 px sectors
+    "legacy": {
+        "cell": 20,
+        "reduce": "sample",
+        "band_edges": (50, 80, 100, 130, 170, 180),
+        "sector_edges": (100, 200, 300),
+        "collision": 12,
+        "threshold": 9,
+    },
+    # 8 px cells keep the nearest pixel, so poles a few pixels wide still show up;
+    # the counts are scaled by the 6.25 times as many cells
+    "fine": {
+        "cell": 8,
+        "reduce": "max",
+        "band_edges": (50, 80, 100, 130, 170, 180),
+        "sector_edges": (100, 200, 300),
+        "collision": 75,
+        "threshold": 56,
+    },
+    # like fine, but a cell needs a tenth of its pixels that near, which ignores speckles
+    "robust": {
+        "cell": 8,
+        "reduce": "percentile",
+        "percentile": 90,
+        "band_edges": (50, 80, 100, 130, 170, 180),
+        "sector_edges": (100, 200, 300),
+        "collision": 75,
+        "threshold": 56,
+    },
+}
+
+
+def sample_grid(frame, spac):
+    # every spac-th pixel in both directions, as a strided view of the frame
+    (rows, cols) = frame.shape
+    return frame[:int(rows / spac) * spac:spac, :int(cols / spac) * spac:spac]
+
+
+def block_view(frame, cell):
+    # (rows, cell, cols, cell) view of the whole cells of the frame, no copy
+    rows, cols = frame.shape[0] // cell, frame.shape[1] // cell
+    return frame[:rows * cell, :cols * cell].reshape(rows, cell, cols, cell)
+
+
+class OccupancyMap:
+    # Distance band of every cell of a raw uint8 disparity frame, and per sector counts of them
+    def __init__(self, config):
+        self.config = config
+        self.cell = config["cell"]
+        self.sectorEdges = np.array(config["sector_edges"])
+        self.sectors = len(self.sectorEdges) + 1
+        if self.sectors < 3:
+            # cal_direct steers between a left, at least one forward and a right sector
+            raise ValueError("sector_edges needs at least 2 edges, got " + str(config["sector_edges"]))
+        # band of every raw disparity, with the 190 - value reversal (and its uint8 wrap-around) folded in
+        self.bandLut = np.searchsorted(np.array(config["band_edges"]), (190 - np.arange(256)) % 256,
+                                       side='left').astype(np.uint8)
+        self.columns = None
+
+    def reduce(self, frame):
+        mode = self.config["reduce"]
+        if mode == "sample":
+            return sample_grid(frame, self.cell)
+        blocks = block_view(frame, self.cell)
+        # larger disparity is nearer
+        if mode == "max":
+            # reducing the rows of each cell first keeps the inner loop on contiguous pixels
+            return blocks.max(axis=1).max(axis=2)
+        if mode == "percentile":
+            cells = blocks.transpose(0, 2, 1, 3).reshape(blocks.shape[0], blocks.shape[2], -1)
+            # the 'lower' percentile is the k-th smallest pixel, a partition finds it without sorting
+            k = int(self.config["percentile"] / 100 * (cells.shape[2] - 1))
+            return np.partition(cells, k, axis=2)[..., k]
+        raise ValueError("Unknown cell reduction " + str(mode))
+
+    def bands(self, frame):
+        # band 0: nearer than the first edge (ignored), 1..len(band_edges): up to that edge, above: farther
+        return self.bandLut[self.reduce(frame)]
+
+    def sectorCounts(self, mask):
+        # number of marked cells per steering sector, mask is (rows, cols) of cells
+        if self.columns is None or len(self.columns) != mask.shape[1]:
+            self.columns = np.searchsorted(self.sectorEdges, np.arange(mask.shape[1]) * self.cell, side='left')
+        counts = np.bincount(self.columns, weights=np.count_nonzero(mask, axis=0), minlength=self.sectors)
+        return counts.astype(int).tolist()
+
+
+class DirectionVoter:
+    # Direction codes of the last `history` frames in a ring buffer, each vote weighted by `decay` per frame of age.
+    # The weighted score of every code is kept up to date, so a vote costs the same however long the history.
+    def __init__(self, history=30, decay=0.87, codes=7):
+        self.codes = np.zeros(history, np.int8)
+        self.decay = decay
+        # weight the oldest vote would have one frame after it leaves the ring
+        self.expired = decay ** history
+        self.scores = np.zeros(codes)
+        self.reset()
+
+    def reset(self):
+        self.pos = 0
+        self.count = 0
+        self.scores[:] = 0
+        self.total = 0.0
+
+    def update(self, code):
+        self.scores *= self.decay
+        self.total *= self.decay
+        if self.count == len(self.codes):
+            self.scores[self.codes[self.pos]] -= self.expired
+            self.total -= self.expired
+        else:
+            self.count += 1
+        self.codes[self.pos] = code
+        self.scores[code] += 1
+        self.total += 1
+        self.pos = (self.pos + 1) % len(self.codes)
+        return self.estimate()
+
+    def estimate(self):
+        # (code, weighted share of the votes), (None, 0.0) before the first vote
+        if self.count == 0:
+            return None, 0.0
+        code = int(self.scores.argmax())
+        return code, self.scores[code] / self.total
+
 
 class ObsDetect:
-    def __init__(self, device: dai.Device):
+    def __init__(self, device: dai.Device, preset="legacy", maxFrameAge=0.15):
         self.device = device
         self.queue = self.device.getOutputQueue(name="disparity", maxSize=4, blocking=False)
+        # always the newest disparity frame, skipping ones older than maxFrameAge seconds
+        self.maxFrameAge = maxFrameAge
+        self.reader = LatestFrameReader(self.queue, self.maxFrameAge, device_clock(device))
+        # a name from OCCUPANCY_PRESETS or a config dict of the same shape
+        self.occupancy = OccupancyMap(OCCUPANCY_PRESETS[preset] if isinstance(preset, str) else preset)
 
     def reverse_number(self, num):
         max_num = 190
         min_num = 0
         return (max_num + min_num) - num
 
-    def region_check(self, foo, list_path):  # foo defines x-coordinate of point
-        if foo <= 100:
-            list_path[0] += 1
-        if (foo > 100) and (foo <= 200):
-            list_path[1] += 1
-        if (foo > 200) and (foo <= 300):
-            list_path[2] += 1
-        if foo > 300:
-            list_path[3] += 1
-        return list_path
-
     def cal_direct(self, list_path: list, list_dir: list, threshold_val: int, display: bool):
 
         # insert a ListPath, t, input img to read
         # Forward
-        if max(list_path[1:3]) <= threshold_val:
+        if max(list_path[1:-1]) <= threshold_val:
             list_dir.append(3)
         # Right
-        elif max(list_path[3:4]) <= threshold_val:
+        elif max(list_path[-1:]) <= threshold_val:
             list_dir.append(4)
         # Left
         elif max(list_path[0:1]) <= threshold_val:
@@ -69,58 +198,33 @@ class ObsDetect:
 
     def get_guide(self, list_dir: list, display: bool):
 
-        threshold_val = 9
-        inDisparity = self.queue.get()
+        occupancy = self.occupancy
+        threshold_val = occupancy.config["threshold"]
+        inDisparity = self.reader.get()
         frame = inDisparity.getFrame()
+        # a no-op view when the device already cropped the disparity to these columns
         frame = frame[::, 0:400]
-        frame = self.reverse_number(frame)
+        spac = occupancy.cell
+        collision_val = occupancy.config["collision"]
         if display:
+            frame = self.reverse_number(frame)
             edges = cv2.Canny(frame, 37, 43)
             contours, hierarchy = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
             cv2.drawContours(frame, contours, -1, (0, 0, 255), -1)
-        # counter += 1
-        spac = 20
-        collision_val = 12
-        (rows, cols) = frame.shape  # 480 rows and 640 cols
-        # print cols
-        flag120 = [0, 0, 0, 0]
-        flag140 = [0, 0, 0, 0]
-        f14 = 0
-        f12 = 0
-        f10 = 0
-        f8 = 0
-        for i in range(int(rows / spac)):  # note the presence of colon
-            for j in range(int(cols / spac)):
-                if frame[spac * i, spac * j] <= 50:
-                    continue
-                # if display:
-                #     cv2.circle(frame, (spac * j, spac * i), 1, (0, 255, 0), 1)
-
-                if frame[spac * i, spac * j] <= 80:
-                    f8 += 1
-                    if display:
-                        cv2.putText(frame, "0", (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20), thickness)
-                elif frame[spac * i, spac * j] <= 100:
-                    f10 += 1
-                    if display:
-                        cv2.putText(frame, "1", (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20), thickness)
-                elif frame[spac * i, spac * j] <= 130:
-                    f12 = 1
-                    if display:
-                        cv2.putText(frame, "2", (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20), thickness)
-                        flag120 = self.region_check(spac * j, flag120)
-                # if f8 == 0 and f10 == 0:
-                # showDirect(flag120)
-                elif frame[spac * i, spac * j] <= 170:
-                    f14 = 1
-                    if display:
-                        cv2.putText(frame, "3", (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20), thickness)
-                    flag140 = self.region_check(spac * j, flag140)
-                # if f8 == 0 and f10 == 0 and f12 == 0:
-                # showDirect(flag140)
-                elif frame[spac * i, spac * j] <= 180:
-                    if display:
-                        cv2.putText(frame, "4", (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20), thickness)
+            # the drawn contours count too, reversing again gives back the raw values
+            bands = occupancy.bands(self.reverse_number(frame))
+        else:
+            bands = occupancy.bands(frame)
+
+        f8 = np.count_nonzero(bands == 1)
+        f10 = np.count_nonzero(bands == 2)
+        f12 = 1 if np.any(bands == 3) else 0
+        flag140 = occupancy.sectorCounts(bands == 4)
+        # the 100-130 band is only counted while displaying
+        if display:
+            flag120 = occupancy.sectorCounts(bands == 3)
+        else:
+            flag120 = [0] * occupancy.sectors
 
         if f8 >= collision_val:
             list_dir.append(1)
@@ -132,6 +236,9 @@ class ObsDetect:
             self.cal_direct(flag140, list_dir, threshold_val, display=display)
 
         if display:
+            for i, j in zip(*np.nonzero((bands >= 1) & (bands <= len(occupancy.config["band_edges"]) - 1))):
+                cv2.putText(frame, str(bands[i, j] - 1), (spac * j, spac * i), cv2.FONT_HERSHEY_PLAIN, 1, (0, 200, 20),
+                            thickness)
             cv2.imshow("disparity", frame)
 
     def retrieve_message(self):
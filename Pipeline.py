@@ -0,0 +1,335 @@
+import time
+
+import depthai as dai
+
+from FrameEngine import FrameEngine
+
+# Node settings, shared by every profile that builds the node
+STEREO_CONFIG = {
+    "extended_disparity": True,
+    # for better accuracy for longer distances
+    "subpixel": False,
+    # better handling for occulsions:
+    "lr_check": False,
+    "median_filter": "KERNEL_7x7",
+    "speckle_range": 5,
+    "lr_check_threshold": 30,
+    # normalized (xmin, ymin, xmax, ymax) cropped on the device, ObsDetect only looks at the left 400 of 640 columns;
+    # None sends the full frame
+    "crop_rect": (0.0, 0.0, 0.625, 1.0),
+}
+
+CAMERA_CONFIG = {
+    "preview_size": (320, 320),
+    "fps": 50,
+}
+
+NN_CONFIG = {
+    "blob_path": 'v5nModel_320/best_openvino_2021.4_6shave.blob',
+    "confidence_threshold": 0.6,
+    "num_classes": 3,
+    "coordinate_size": 4,
+    # 320 * 320
+    "anchors": [
+        10.0, 13.0,
+        16.0, 30.0,
+        33.0, 23.0,
+        30.0, 61.0,
+        62.0, 45.0,
+        59.0, 119.0,
+        116.0, 90.0,
+        156.0, 198.0,
+        373.0, 326.0
+    ],
+    "anchor_masks": {
+        "side40": [0, 1, 2],
+        "side20": [3, 4, 5],
+        "side10": [6, 7, 8]
+    },
+    "iou_threshold": 0.5,
+}
+
+# Which parts of the pipeline each profile builds, and the output streams that come with them:
+# "stereo" -> disparity, "detection" -> rgb and nn, "gray" -> gray, the nn passthrough converted on the device,
+# "gate" -> the outputs pass a script node that can pause and resume each of them at runtime
+PIPELINE_PROFILES = {
+    "stereo": ("stereo",),
+    "detection": ("detection", "gray"),
+    "combined": ("stereo", "detection", "gray"),
+    "switchable": ("stereo", "detection", "gray", "gate"),
+}
+
+# Input stream of the gate script, messages are b"<stream>=1" to resume and b"<stream>=0" to pause
+STREAM_CONTROL = "streamctl"
+
+# Control inputs of the cameras in a gated profile and the streams that come from each camera:
+# a camera whose streams are all paused is stopped, so the sensor, stereo and the nn do not run for nothing
+CAMERA_CONTROLS = {
+    "monoctl": ("disparity",),
+    "colorctl": ("rgb", "nn", "gray"),
+}
+
+# Runs on the device: forwards <stream>_in to <stream> while the stream is enabled, all start paused
+GATE_SCRIPT = """
+import time
+enabled = {%s}
+while True:
+    ctrl = node.io['%s'].tryGet()
+    while ctrl is not None:
+        name, state = bytes(ctrl.getData()).decode().split('=')
+        enabled[name] = state == '1'
+        ctrl = node.io['%s'].tryGet()
+    idle = True
+    for name in enabled:
+        msg = node.io[name + '_in'].tryGet()
+        if msg is not None:
+            idle = False
+            if enabled[name]:
+                node.io[name].send(msg)
+    if idle:
+        time.sleep(0.001)
+"""
+
+
+class PipelineManger:
+    def __init__(self, processes=False):
+        self.pipeline = None
+        self.device = None
+        self.profile = None
+        self.engine = None
+        # streams the current services need, the others are paused
+        self.streams = None
+        # run the detectors of the frame engine in worker processes instead of threads
+        self.processes = processes
+
+    def setup_pipeline(self, profile="combined"):
+        # Create pipeline
+        pipe = dai.Pipeline()
+        parts = PIPELINE_PROFILES[profile]
+        controlled = "gate" in parts
+        outputs = {}
+        if "stereo" in parts:
+            outputs.update(self.setup_stereo(pipe, controlled))
+        if "detection" in parts:
+            outputs.update(self.setup_detection(pipe, controlled))
+        if "gray" in parts:
+            outputs.update(self.setup_gray(pipe, outputs["rgb"]))
+        if "gate" in parts:
+            outputs = self.setup_gate(pipe, outputs)
+        for name, output in outputs.items():
+            xout = pipe.create(dai.node.XLinkOut)
+            xout.setStreamName(name)
+            output.link(xout.input)
+        self.pipeline = pipe
+        self.profile = profile
+
+    def setup_gate(self, pipe, outputs):
+        names = ", ".join("'%s': False" % name for name in outputs)
+        script = pipe.create(dai.node.Script)
+        script.setScript(GATE_SCRIPT % (names, STREAM_CONTROL, STREAM_CONTROL))
+
+        control = pipe.create(dai.node.XLinkIn)
+        control.setStreamName(STREAM_CONTROL)
+        control.out.link(script.inputs[STREAM_CONTROL])
+
+        gated = {}
+        for name, output in outputs.items():
+            # only the newest frame waits at the gate, paused frames are dropped on the device
+            output.link(script.inputs[name + "_in"])
+            script.inputs[name + "_in"].setBlocking(False)
+            script.inputs[name + "_in"].setQueueSize(1)
+            gated[name] = script.outputs[name]
+        return gated
+
+    def setup_camera_control(self, pipe, name, cameras):
+        control = pipe.create(dai.node.XLinkIn)
+        control.setStreamName(name)
+        for camera in cameras:
+            control.out.link(camera.inputControl)
+
+    def setup_stereo(self, pipe, controlled=False):
+        config = STEREO_CONFIG
+
+        # Define node
+        monoLeft = pipe.create(dai.node.MonoCamera)
+        monoRight = pipe.create(dai.node.MonoCamera)
+        stereo = pipe.create(dai.node.StereoDepth)
+
+        # Setting properties for depth camera
+        monoLeft.setBoardSocket(dai.CameraBoardSocket.LEFT)
+        monoLeft.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
+        monoRight.setBoardSocket(dai.CameraBoardSocket.RIGHT)
+        monoRight.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
+
+        # Depth node settings
+        stereo.setDefaultProfilePreset(dai.node.StereoDepth.PresetMode.HIGH_DENSITY)
+        # stereo.setRectifyEdgeFillColor(0)
+        stereo.initialConfig.setMedianFilter(getattr(dai.MedianFilter, config["median_filter"]))
+        stereo.setLeftRightCheck(config["lr_check"])
+        stereo.setExtendedDisparity(config["extended_disparity"])
+        stereo.setSubpixel(config["subpixel"])
+
+        stereoConfig = stereo.initialConfig.get()
+        stereoConfig.postProcessing.speckleFilter.enable = True
+        stereoConfig.postProcessing.speckleFilter.speckleRange = config["speckle_range"]
+        stereoConfig.postProcessing.temporalFilter.enable = False
+        stereoConfig.postProcessing.spatialFilter.enable = False
+        stereoConfig.postProcessing.spatialFilter.holeFillingRadius = 2
+        stereoConfig.postProcessing.spatialFilter.numIterations = 1
+        # stereoConfig.postProcessing.thresholdFilter.minRange = 400
+        # stereoConfig.postProcessing.thresholdFilter.maxRange = 270
+        stereoConfig.postProcessing.decimationFilter.decimationFactor = 1
+        stereo.initialConfig.set(stereoConfig)
+        # depth.initialConfig.setConfidenceThreshold(195)
+        stereo.initialConfig.setLeftRightCheckThreshold(config["lr_check_threshold"])
+
+        # Linking
+        monoLeft.out.link(stereo.left)
+        monoRight.out.link(stereo.right)
+        if controlled:
+            self.setup_camera_control(pipe, "monoctl", (monoLeft, monoRight))
+        if config["crop_rect"] is None:
+            return {"disparity": stereo.disparity}
+
+        crop = pipe.create(dai.node.ImageManip)
+        crop.initialConfig.setCropRect(*config["crop_rect"])
+        crop.inputImage.setBlocking(False)
+        crop.inputImage.setQueueSize(1)
+        stereo.disparity.link(crop.inputImage)
+        return {"disparity": crop.out}
+
+    def setup_detection(self, pipe, controlled=False):
+        config = NN_CONFIG
+
+        # Define node
+        camRgb = pipe.create(dai.node.ColorCamera)
+        detectionNetwork = pipe.create(dai.node.YoloDetectionNetwork)
+
+        # camRgb.setPreviewSize(640, 640)
+        camRgb.setPreviewSize(*CAMERA_CONFIG["preview_size"])
+        camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
+        camRgb.setInterleaved(False)
+        camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
+        camRgb.setFps(CAMERA_CONFIG["fps"])
+
+        # Network specific settings
+        detectionNetwork.setConfidenceThreshold(config["confidence_threshold"])
+        detectionNetwork.setNumClasses(config["num_classes"])
+        detectionNetwork.setCoordinateSize(config["coordinate_size"])
+        detectionNetwork.setAnchors(config["anchors"])
+        detectionNetwork.setAnchorMasks(config["anchor_masks"])
+        detectionNetwork.setIouThreshold(config["iou_threshold"])
+        detectionNetwork.setBlobPath(config["blob_path"])
+        detectionNetwork.input.setBlocking(False)
+
+        # Linking
+        camRgb.preview.link(detectionNetwork.input)
+        if controlled:
+            self.setup_camera_control(pipe, "colorctl", (camRgb,))
+        return {"rgb": detectionNetwork.passthrough, "nn": detectionNetwork.out}
+
+    def setup_gray(self, pipe, rgb):
+        # the escalator tracker only needs gray pixels, a third of the bytes of the BGR frame
+        manip = pipe.create(dai.node.ImageManip)
+        manip.initialConfig.setFrameType(dai.ImgFrame.Type.GRAY8)
+        rgb.link(manip.inputImage)
+        return {"gray": manip.out}
+
+    def create_device(self):
+        self.device = dai.Device(self.pipeline)
+        return self.device
+
+    def get_device(self):
+        return self.device
+
+    def is_healthy(self):
+        if self.device is None:
+            return False
+        try:
+            return not self.device.isClosed() and self.device.isPipelineRunning()
+        except RuntimeError:
+            return False
+
+    def acquire_device(self):
+        # keep the warm device across client sessions, rebuild it only after a fault
+        # returns (device, reused)
+        if self.is_healthy():
+            return self.device, True
+        if self.device is not None:
+            print("Device is not healthy, rebuilding the pipeline ...")
+            self.close_device()
+        st = time.time()
+        device = self.create_device()
+        print("Device started with the", self.profile, "profile in %.2f seconds" % (time.time() - st))
+        return device, False
+
+    def acquire_engine(self):
+        # the frame engine of the current device, started again whenever the device is new
+        if self.engine is not None and not self.engine.running:
+            # the engine lost the device queues, treat it as a device fault
+            self.close_device()
+        device, reused = self.acquire_device()
+        if self.engine is None or not reused:
+            self.engine = FrameEngine(device, processes=self.processes)
+            self.engine.start()
+            # the gate starts with every stream paused, the engine has to agree with it
+            if self.streams is not None or "gate" in PIPELINE_PROFILES[self.profile]:
+                self.set_streams(self.streams or ())
+        return self.engine
+
+    def set_streams(self, streams):
+        # resume the given streams and pause the others without rebuilding the device;
+        # the gate stops paused streams on the device, the engine stops handling them on the host
+        self.streams = tuple(streams)
+        # a faulted device is rebuilt by the next acquire_engine(), which applies self.streams again
+        if self.engine is None or not self.engine.running or not self.is_healthy():
+            return
+        gated = "gate" in PIPELINE_PROFILES[self.profile]
+        try:
+            for name in self.device.getOutputQueueNames():
+                enabled = name in self.streams
+                if gated:
+                    control = dai.Buffer()
+                    control.setData(list(("%s=%d" % (name, enabled)).encode()))
+                    self.device.getInputQueue(STREAM_CONTROL).send(control)
+                if enabled:
+                    self.engine.resumeStream(name)
+                else:
+                    self.engine.pauseStream(name)
+            if gated:
+                self.set_cameras()
+        except RuntimeError as e:
+            print("Failed to switch streams, the device will be rebuilt:", e)
+
+    def set_cameras(self):
+        # stop the cameras whose streams are all paused and start the others again,
+        # a camera takes a few frames to come back so resuming its streams costs that much more
+        names = self.device.getOutputQueueNames()
+        for control, streams in CAMERA_CONTROLS.items():
+            if not any(name in names for name in streams):
+                continue
+            ctrl = dai.CameraControl()
+            if any(name in self.streams for name in streams):
+                ctrl.setStartStreaming()
+            else:
+                ctrl.setStopStreaming()
+            self.device.getInputQueue(control).send(ctrl)
+
+    def switch_profile(self, profile):
+        # rebuilds the device only when the profile actually changes
+        if profile != self.profile:
+            print("Switching pipeline profile from", self.profile, "to", profile, "...")
+            self.close_device()
+            self.setup_pipeline(profile)
+        return self.acquire_engine()
+
+    def close_device(self):
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+        if self.device is not None:
+            try:
+                self.device.close()
+            except RuntimeError:
+                pass
+            self.device = None
@@ -0,0 +1,143 @@
+import codecs
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Wire format in both directions: one compact JSON object per line.
+# The decoder also accepts objects sent back to back without a newline, as older clients do.
+# Responses can instead use a compact encoding picked by the client with
+# {"mode": "hello", "encoding": "binary" | "msgpack"}, JSON stays the default.
+
+# Enum codes of the response actions and messages, the index is the code. Only append to these lists.
+ACTIONS = [
+    "switch mode",
+    "obstacle detection",
+    "elevator direction",
+    "hello",
+]
+MESSAGES = [
+    # ObsDetect.get_direct_msg
+    "前方不便前行",
+    "向前走",
+    "向右走",
+    "向左走",
+    "向後走",
+    # EscalatorDetector.ang2EscDirection and run()
+    "電梯向上",
+    "電梯向下",
+    "電梯靜止",
+    "找不到電梯",
+    # sendSwitchServiceResponse
+    "障礙物模式",
+    "電梯模式",
+    "unknown command模式",
+    # hello replies
+    "json",
+    "binary",
+    "msgpack",
+]
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+MESSAGE_CODES = {message: code for code, message in enumerate(MESSAGES)}
+# message code followed by a length byte and the UTF-8 text, for messages not in MESSAGES
+TEXT_CODE = 0xFF
+
+# binary frame: magic byte, action code, message code
+BINARY_MAGIC = 0xAE
+binary_frame = struct.Struct(">BBB")
+
+
+def encode_message(message: dict) -> bytes:
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def supported_encodings():
+    encodings = ["json", "binary"]
+    if msgpack is not None:
+        encodings.append("msgpack")
+    return encodings
+
+
+class ResponseEncoder:
+    def __init__(self, encoding="json"):
+        if encoding not in supported_encodings():
+            raise ValueError("Unsupported encoding " + str(encoding))
+        self.encoding = encoding
+
+    def encode(self, action: str, message: str) -> bytes:
+        if self.encoding == "json":
+            return encode_message({"action": action, "message": message})
+        actionCode = ACTION_CODES[action]
+        messageCode = MESSAGE_CODES.get(message, TEXT_CODE)
+        if self.encoding == "msgpack":
+            fields = [actionCode, messageCode] if messageCode != TEXT_CODE else [actionCode, messageCode, message]
+            return msgpack.packb(fields)
+        frame = binary_frame.pack(BINARY_MAGIC, actionCode, messageCode)
+        if messageCode == TEXT_CODE:
+            text = message.encode("utf-8")[:255]
+            frame += bytes([len(text)]) + text
+        return frame
+
+
+class MessageDecoder:
+    # Buffers partial reads and returns every complete message received so far
+    def __init__(self, maxBuffer=65536):
+        self.maxBuffer = maxBuffer
+        self.textDecoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        # number of malformed messages or stray bytes dropped
+        self.errors = 0
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += self.textDecoder.decode(data)
+        messages = []
+        start = None
+        depth = 0
+        inString = False
+        escape = False
+        skipping = False
+        consumed = 0
+        for i, ch in enumerate(self.buffer):
+            if start is None:
+                # between messages: skip separators, drop anything that cannot start an object
+                if ch == "{":
+                    start = i
+                    depth = 1
+                    skipping = False
+                else:
+                    if ch.isspace():
+                        skipping = False
+                    elif not skipping:
+                        self.errors += 1
+                        skipping = True
+                    consumed = i + 1
+                continue
+            if inString:
+                if escape:
+                    escape = False
+                elif ch == "\\":
+                    escape = True
+                elif ch == '"':
+                    inString = False
+            elif ch == '"':
+                inString = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        messages.append(json.loads(self.buffer[start:i + 1]))
+                    except ValueError:
+                        self.errors += 1
+                    start = None
+                    consumed = i + 1
+        self.buffer = self.buffer[consumed:]
+        if len(self.buffer) > self.maxBuffer:
+            # a message this long is never going to be valid
+            self.buffer = ""
+            self.errors += 1
+        return messages
@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from FrameStore import FrameStore, index_dtype
+
+# How each stream is stored: "cv" keeps getCvFrame(), "raw" keeps getFrame() in a FrameStore,
+# "detections" keeps the nn results
+STREAM_KINDS = {
+    "rgb": "cv",
+    "disparity": "raw",
+    "gray": "raw",
+    "nn": "detections",
+}
+
+detection_dtype = np.dtype([
+    ("label", np.int32),
+    ("confidence", np.float32),
+    ("xmin", np.float32),
+    ("ymin", np.float32),
+    ("xmax", np.float32),
+    ("ymax", np.float32),
+])
+
+
+class SessionRecorder:
+    def __init__(self, device, path, streams=("rgb", "nn", "disparity")):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.queues = {name: device.getOutputQueue(name=name, maxSize=4, blocking=False) for name in streams}
+        # image streams go straight to disk, detections are small enough to keep until save()
+        self.stores = {}
+        self.detections = {}
+        for name in streams:
+            if STREAM_KINDS[name] == "detections":
+                self.detections[name] = ([], [])
+            else:
+                self.stores[name] = FrameStore.create(os.path.join(path, name))
+
+    def poll(self):
+        count = 0
+        for name, queue in self.queues.items():
+            for msg in queue.tryGetAll():
+                ts = msg.getTimestamp().total_seconds()
+                seq = msg.getSequenceNum()
+                if name in self.stores:
+                    frame = msg.getCvFrame() if STREAM_KINDS[name] == "cv" else msg.getFrame()
+                    self.stores[name].append(frame, ts, seq)
+                else:
+                    index, dets = self.detections[name]
+                    index.append((ts, seq))
+                    dets.append([(d.label, d.confidence, d.xmin, d.ymin, d.xmax, d.ymax) for d in msg.detections])
+                count += 1
+        return count
+
+    def record(self, seconds):
+        timeout = time.time() + seconds
+        while time.time() < timeout:
+            if self.poll() == 0:
+                time.sleep(0.001)
+        self.save()
+
+    def save(self):
+        for store in self.stores.values():
+            store.close()
+        for name, (index, dets) in self.detections.items():
+            base = os.path.join(self.path, name)
+            np.save(base + ".index.npy", np.array(index, dtype=index_dtype))
+            np.save(base + ".offsets.npy", np.cumsum([0] + [len(d) for d in dets]))
+            np.save(base + ".dets.npy", np.array([d for frame in dets for d in frame], dtype=detection_dtype))
+        with open(os.path.join(self.path, "session.json"), "w") as f:
+            streams = {name: STREAM_KINDS[name] for name in self.queues}
+            json.dump({"version": 2, "streams": streams}, f, indent=4)
+        print("Session saved to", self.path)
+
+
+class DetectionStore:
+    # Detections of every recorded nn message, sliced per message with offsets
+    def __init__(self, path):
+        self.index = np.load(path + ".index.npy")
+        self.offsets = np.load(path + ".offsets.npy")
+        self.dets = np.load(path + ".dets.npy")
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def ts(self):
+        return self.index["ts"]
+
+    @property
+    def seq(self):
+        return self.index["seq"]
+
+
+class ReplayFrame:
+    def __init__(self, frame, ts, seq):
+        self.frame = frame
+        self.ts = ts
+        self.seq = seq
+
+    def getCvFrame(self):
+        return self.frame
+
+    def getFrame(self):
+        return self.frame
+
+    def getTimestamp(self):
+        return timedelta(seconds=self.ts)
+
+    def getSequenceNum(self):
+        return self.seq
+
+
+class ReplayDetection:
+    def __init__(self, row):
+        self.label = int(row["label"])
+        self.confidence = float(row["confidence"])
+        self.xmin = float(row["xmin"])
+        self.ymin = float(row["ymin"])
+        self.xmax = float(row["xmax"])
+        self.ymax = float(row["ymax"])
+
+
+class ReplayDetections:
+    def __init__(self, rows, ts, seq):
+        self.detections = [ReplayDetection(row) for row in rows]
+        self.ts = ts
+        self.seq = seq
+
+    def getTimestamp(self):
+        return timedelta(seconds=self.ts)
+
+    def getSequenceNum(self):
+        return self.seq
+
+
+class ReplayQueue:
+    def __init__(self, device, name, maxSize, blocking):
+        self.device = device
+        self.name = name
+        self.maxSize = maxSize
+        self.blocking = blocking
+        self.store = device.streams[name]
+        # recorded time of every message relative to the start of the session
+        self.offsets = self.store.ts - device.t0
+        self.index = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def available(self):
+        # number of messages the device has produced so far
+        if not self.device.realtime:
+            return len(self)
+        return int(np.searchsorted(self.offsets, self.device.elapsed(), side="right"))
+
+    def message(self, idx):
+        ts = float(self.store.ts[idx])
+        seq = int(self.store.seq[idx])
+        if isinstance(self.store, DetectionStore):
+            offsets = self.store.offsets
+            return ReplayDetections(self.store.dets[offsets[idx]:offsets[idx + 1]], ts, seq)
+        return ReplayFrame(self.store.frame(idx), ts, seq)
+
+    def tryGet(self):
+        if self.device.isClosed():
+            raise RuntimeError("Replay device is closed")
+        available = self.available()
+        if self.device.realtime and not self.blocking:
+            # a non-blocking device queue only keeps the newest maxSize messages
+            self.index = max(self.index, available - self.maxSize)
+        if self.index >= available:
+            return None
+        msg = self.message(self.index)
+        self.index += 1
+        return msg
+
+    def get(self):
+        while True:
+            msg = self.tryGet()
+            if msg is not None:
+                return msg
+            if self.index >= len(self):
+                raise RuntimeError("End of recorded session on stream " + self.name)
+            time.sleep(max(0.0, self.offsets[self.index] - self.device.elapsed()) / self.device.speed)
+
+    def tryGetAll(self):
+        msgs = []
+        msg = self.tryGet()
+        while msg is not None:
+            msgs.append(msg)
+            msg = self.tryGet()
+        return msgs
+
+    def has(self):
+        return self.index < self.available()
+
+
+class ReplayDevice:
+    # Stands in for dai.Device, serving a recorded session through getOutputQueue
+    def __init__(self, path, realtime=True, speed=1.0):
+        self.path = path
+        self.realtime = realtime
+        # recorded seconds played per second in realtime, above 1 to load the detectors harder
+        self.speed = speed
+        with open(os.path.join(path, "session.json")) as f:
+            kinds = json.load(f)["streams"]
+        self.streams = {}
+        for name, kind in kinds.items():
+            base = os.path.join(path, name)
+            self.streams[name] = DetectionStore(base) if kind == "detections" else FrameStore.open(base)
+        starts = [store.ts[0] for store in self.streams.values() if len(store)]
+        self.t0 = min(starts) if starts else 0.0
+        self.startTime = None
+        self.queues = {}
+        self.closed = False
+
+    def elapsed(self):
+        # the replay clock starts with the first read from any queue
+        if self.startTime is None:
+            self.startTime = time.monotonic()
+        return (time.monotonic() - self.startTime) * self.speed
+
+    def clock(self):
+        # recorded time of the replay clock, frames carry no real time when replaying as fast as possible
+        if not self.realtime:
+            return None
+        return timedelta(seconds=self.t0 + self.elapsed())
+
+    def getOutputQueueNames(self):
+        return list(self.streams)
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        if name not in self.queues:
+            self.queues[name] = ReplayQueue(self, name, maxSize, blocking)
+        return self.queues[name]
+
+    def isClosed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def record_session(path, seconds):
+    from Pipeline import PipelineManger
+
+    pipe_manager = PipelineManger()
+    pipe_manager.setup_pipeline()
+    with pipe_manager.create_device() as device:
+        SessionRecorder(device, path).record(seconds)
+
+
+def bench_session(path, realtime):
+    from ObsDetect import ObsDetect
+    from EscDetect import EscalatorDetector
+
+    with ReplayDevice(path, realtime=realtime) as device:
+        detector = ObsDetect(device)
+        direction = []
+        st = time.time()
+        try:
+            while True:
+                detector.get_guide(list_dir=direction, display=False)
+        except RuntimeError:
+            pass
+        elapsed = time.time() - st
+        print("Obstacle: %d frames in %.2f s (%.1f fps)" % (len(direction), elapsed, len(direction) / max(elapsed, 1e-9)))
+        print("Obstacle frames:", detector.reader.summary())
+
+    with ReplayDevice(path, realtime=realtime) as device:
+        detector = EscalatorDetector(device)
+        runs = 0
+        st = time.time()
+        while True:
+            status, msg, stats = detector.run()
+            if detector.pipelineError:
+                break
+            runs += 1
+            print("Escalator: %s %s in %.2f s, confidence %.2f" % (status, msg, stats["elapsed"], stats["confidence"]))
+            print("Escalator frames:", detector.frameSummary())
+        print("Escalator: %d runs in %.2f s" % (runs, time.time() - st))
+
+
+def bench_engine(path, processes, speed):
+    # both detectors at once through the frame engine, as threads or as worker processes
+    from FrameEngine import FrameEngine
+
+    with ReplayDevice(path, realtime=True, speed=speed) as device:
+        engine = FrameEngine(device, processes=processes)
+        engine.obstaclePreset = "fine"
+        st = time.time()
+        engine.start()
+        # most of the session at the replay speed, the workers have to be running when deactivated
+        end = st + 0.9 * (max(store.ts[-1] for store in device.streams.values() if len(store)) - device.t0) / speed
+        if processes:
+            # worker processes take a moment to import, the session is already playing meanwhile
+            for worker in engine.availableWorkers():
+                engine.results.wait(worker + ".ready", 0, 30)
+        runs = 0
+        last = 0
+        st = time.time()
+        for worker in engine.active:
+            engine.setActive(worker, True)
+        while engine.running and time.time() < end:
+            result = engine.results.wait("escalator", last, 0.1)
+            if result is not None:
+                last = result[0]
+                runs += 1
+        elapsed = time.time() - st
+        for worker in engine.active:
+            engine.setActive(worker, False)
+        stats = engine.results.wait("obstacle.frames", st, 2)
+        engine.stop()
+    mode = "processes" if processes else "threads"
+    if stats is not None:
+        frames = stats[1]["frames"]
+        print("Engine (%s): obstacle %d frames in %.2f s (%.1f fps)" % (mode, frames, elapsed, frames / elapsed))
+    print("Engine (%s): escalator %d runs in %.2f s" % (mode, runs, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record or replay OAK-D sessions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="record the rgb, nn and disparity streams")
+    rec.add_argument("path")
+    rec.add_argument("--seconds", type=float, default=30)
+    bench = sub.add_parser("bench", help="run the detectors over a recorded session")
+    bench.add_argument("path")
+    bench.add_argument("--realtime", action="store_true", help="replay at recorded pace")
+    engine = sub.add_parser("engine", help="run both detectors through the frame engine at once")
+    engine.add_argument("path")
+    engine.add_argument("--processes", action="store_true", help="one worker process per detector")
+    engine.add_argument("--speed", type=float, default=1.0, help="recorded seconds per second")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_session(args.path, args.seconds)
+    elif args.command == "engine":
+        bench_engine(args.path, args.processes, args.speed)
+    else:
+        bench_session(args.path, args.realtime)
@@ -0,0 +1,281 @@
+import queue
+import time
+from collections import deque
+from datetime import timedelta
+from multiprocessing import shared_memory
+
+import cv2
+import depthai as dai
+import numpy as np
+
+from SessionReplay import STREAM_KINDS, ReplayDetections, ReplayFrame, detection_dtype
+
+
+class SharedFrameRing:
+    # `slots` fixed-shape frames in one shared memory block, written by the frame engine's pump and
+    # read by a worker process. Each slot has a generation counter, odd while the slot is being written,
+    # so a reader that fell a whole ring behind notices the overwritten frame instead of reading it torn.
+    def __init__(self, shm, shape, dtype, slots, owner):
+        self.shm = shm
+        self.owner = owner
+        frameBytes = int(np.prod(shape)) * dtype.itemsize
+        self.frames = np.ndarray((slots,) + tuple(shape), dtype, buffer=shm.buf)
+        self.gens = np.ndarray((slots,), np.int64, buffer=shm.buf, offset=slots * frameBytes)
+        self.next = 0
+
+    @classmethod
+    def create(cls, shape, dtype, slots=4):
+        dtype = np.dtype(dtype)
+        size = slots * (int(np.prod(shape)) * dtype.itemsize + 8)
+        ring = cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype, slots, owner=True)
+        ring.gens[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype, slots = spec
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before Python 3.13 attaching registers the block again, with the resource tracker the
+            # worker shares with the frame engine, which unregisters it when unlinking
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, np.dtype(dtype), slots, owner=False)
+
+    def spec(self):
+        return self.shm.name, self.frames.shape[1:], self.frames.dtype.str, len(self.frames)
+
+    def write(self, frame):
+        # returns (slot, generation) for the reader
+        slot = self.next
+        self.next = (slot + 1) % len(self.frames)
+        self.gens[slot] += 1
+        self.frames[slot] = frame
+        self.gens[slot] += 1
+        return slot, int(self.gens[slot])
+
+    def read(self, slot, gen):
+        # a private copy of the frame, or None if the slot was written again in the meantime
+        if self.gens[slot] != gen:
+            return None
+        frame = self.frames[slot].copy()
+        if self.gens[slot] != gen:
+            return None
+        return frame
+
+    def close(self):
+        self.frames = None
+        self.gens = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedFrameOutlet:
+    # Frame engine subscriber for a stream of a worker process, same push / clear / wake interface
+    # as EngineQueue: images go into a SharedFrameRing, the inbox only carries where to find them
+    def __init__(self, inbox, name, slots=8):
+        self.inbox = inbox
+        self.name = name
+        self.kind = STREAM_KINDS.get(name, "raw")
+        self.slots = slots
+        self.ring = None
+        # rings replaced after a resolution change, the worker may still be attaching to them
+        self.retired = []
+
+    def push(self, msg):
+        ts = msg.getTimestamp().total_seconds()
+        seq = msg.getSequenceNum()
+        if self.kind == "detections":
+            self.inbox.put(("dets", self.name, detection_rows(msg), ts, seq))
+            return
+        if hasattr(msg, "getType"):
+            # the bytes as the device sent them, a worker that needs BGR pixels converts them itself
+            frame = msg.getData()
+            meta = (msg.getType().name, msg.getWidth(), msg.getHeight())
+        else:
+            # replayed frames are stored converted already
+            frame = msg.getCvFrame() if self.kind == "cv" else msg.getFrame()
+            meta = None
+        ring = self.ring
+        if ring is None or ring.frames.shape[1:] != frame.shape or ring.frames.dtype != frame.dtype:
+            if ring is not None:
+                self.retired.append(ring)
+            ring = self.ring = SharedFrameRing.create(frame.shape, frame.dtype, self.slots)
+            self.inbox.put(("ring", self.name, ring.spec()))
+        slot, gen = ring.write(frame)
+        self.inbox.put(("frame", self.name, slot, gen, ts, seq, meta))
+
+    def clear(self):
+        self.inbox.put(("clear", self.name))
+
+    def wake(self):
+        pass
+
+    def close(self):
+        for ring in self.retired + ([self.ring] if self.ring is not None else []):
+            ring.close()
+        self.ring = None
+        self.retired = []
+
+
+class SharedImgFrame:
+    # ImgFrame rebuilt in a worker from its raw data, converted like getFrame / getCvFrame on demand
+    def __init__(self, data, meta, ts, seq):
+        self.data = data
+        self.typeName, self.width, self.height = meta
+        self.ts = ts
+        self.seq = seq
+
+    def getData(self):
+        return self.data
+
+    def getType(self):
+        return getattr(dai.ImgFrame.Type, self.typeName)
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def getFrame(self):
+        w, h = self.width, self.height
+        if self.typeName == "RAW16":
+            return self.data.view(np.uint16).reshape(h, w)
+        if self.typeName.endswith("p") and self.typeName.startswith(("BGR", "RGB")):
+            return self.data.reshape(3, h, w)
+        if self.typeName.endswith("i"):
+            return self.data.reshape(h, w, 3)
+        if self.typeName in ("NV12", "YUV420p"):
+            return self.data.reshape(h * 3 // 2, w)
+        return self.data.reshape(h, w)
+
+    def getCvFrame(self):
+        frame = self.getFrame()
+        if self.typeName in ("BGR888p", "RGB888p"):
+            frame = frame.transpose(1, 2, 0)
+        if self.typeName in ("NV12", "YUV420p"):
+            return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_NV12 if self.typeName == "NV12" else cv2.COLOR_YUV2BGR_IYUV)
+        if self.typeName.startswith("RGB"):
+            frame = frame[..., ::-1]
+        return np.ascontiguousarray(frame)
+
+    def getTimestamp(self):
+        return timedelta(seconds=self.ts)
+
+    def getSequenceNum(self):
+        return self.seq
+
+
+class ProcessQueue:
+    # A worker process' end of one stream, same get / tryGet / tryGetAll interface as EngineQueue
+    def __init__(self, device, maxSize):
+        self.device = device
+        self.messages = deque(maxlen=maxSize)
+
+    def tryGet(self):
+        self.device.poll(0)
+        return self.messages.popleft() if self.messages else None
+
+    def get(self):
+        while not self.messages:
+            self.device.poll(0.1)
+        return self.messages.popleft()
+
+    def tryGetAll(self):
+        self.device.poll(0)
+        msgs = list(self.messages)
+        self.messages.clear()
+        return msgs
+
+    def has(self):
+        self.device.poll(0)
+        return len(self.messages) > 0
+
+
+class ProcessDevice:
+    # Device stand-in inside a worker process, fed by the frame engine through `inbox`:
+    # ("ring", name, spec) announces the shared ring of an image stream, ("frame", name, slot, gen, ts, seq, meta)
+    # a frame in it, meta being (type name, width, height) of raw ImgFrame data, ("dets", name, rows, ts, seq) detections, ("clear", name) drops what is queued,
+    # None stops the worker.
+    def __init__(self, inbox, names, clockSpec, stopping):
+        self.inbox = inbox
+        self.names = names
+        # (offset, rate): the device clock is rate * time.monotonic() + offset, None without a clock
+        self.clockSpec = clockSpec
+        self.stopping = stopping
+        self.rings = {}
+        self.queues = {}
+        self.overwritten = 0
+
+    def getOutputQueueNames(self):
+        return list(self.names)
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        if name not in self.queues:
+            self.queues[name] = ProcessQueue(self, maxSize)
+        return self.queues[name]
+
+    def clock(self):
+        if self.clockSpec is None:
+            return None
+        offset, rate = self.clockSpec
+        return timedelta(seconds=time.monotonic() * rate + offset)
+
+    def isClosed(self):
+        return self.stopping.is_set()
+
+    def poll(self, timeout):
+        # moves everything waiting in the inbox to the stream queues, waiting up to timeout for the first item
+        if self.stopping.is_set():
+            raise RuntimeError("Frame engine stopped")
+        try:
+            item = self.inbox.get(timeout=timeout) if timeout else self.inbox.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            self.dispatch(item)
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                return
+
+    def dispatch(self, item):
+        if item is None:
+            self.stopping.set()
+            raise RuntimeError("Frame engine stopped")
+        kind, name = item[0], item[1]
+        if kind == "ring":
+            if name in self.rings:
+                self.rings[name].close()
+            self.rings[name] = SharedFrameRing.attach(item[2])
+            return
+        if kind == "clear":
+            if name in self.queues:
+                self.queues[name].messages.clear()
+            return
+        if name not in self.queues:
+            return
+        if kind == "frame":
+            _, _, slot, gen, ts, seq, meta = item
+            frame = self.rings[name].read(slot, gen)
+            if frame is None:
+                self.overwritten += 1
+                return
+            msg = ReplayFrame(frame, ts, seq) if meta is None else SharedImgFrame(frame, meta, ts, seq)
+        else:
+            _, _, rows, ts, seq = item
+            msg = ReplayDetections(rows, ts, seq)
+        self.queues[name].messages.append(msg)
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+
+def detection_rows(msg):
+    # the detections of one nn message as a small array, cheap to send to a worker
+    return np.array([(d.label, d.confidence, d.xmin, d.ymin, d.xmax, d.ymax) for d in msg.detections],
+                    dtype=detection_dtype)
@@ -1,15 +1,19 @@
+import asyncio
+import os
 import random
-import threading
+import socket
 import time
+from collections import deque
 
 import bluetooth as bt
-import json
-from EscDetect import EscalatorDetector as eDetector
-from ObsDetect import ObsDetect as oDetector
-import depthai as dai
-from collections import Counter
+from FrameEngine import FrameEngine
+from Notifier import Notifier
+from Pipeline import PipelineManger
+from Protocol import MessageDecoder, ResponseEncoder, supported_encodings
 
-escalaIsRunning = False
+
+# responses carrying a detection result, as opposed to handshake and mode switch replies
+RESULT_ACTIONS = ("obstacle detection", "elevator direction")
 
 
 class BluetoothServer:
@@ -22,6 +26,20 @@ class BluetoothServer:
         else:
             self.serverSocket = serverSocket
             self.clientSocket = clientSocket
+        # set by startSession() inside the event loop of a client session
+        self.loop = None
+        self.transport = None
+        self.outgoing = None
+        self.writerTask = None
+        self.decoder = None
+        self.pending = deque()
+        # detection results go through the notifier, which drops repeats and rate limits them
+        self.notifier = Notifier(self)
+        # response encoding of the current client, negotiated with a hello message
+        self.encoder = ResponseEncoder()
+        # when the current client connected and how long its first detection result took
+        self.connectedAt = None
+        self.firstResultLatency = None
 
     def getBluetoothSocket(self):
         try:
@@ -63,6 +81,8 @@ class BluetoothServer:
     def acceptBluetoothConnection(self):
         try:
             self.clientSocket, client_info = self.serverSocket.accept()
+            self.connectedAt = time.time()
+            self.firstResultLatency = None
             print("Accepted bluetooth connection from ", client_info)
 
         except (Exception, bt.BluetoothError, SystemExit, KeyboardInterrupt):
@@ -73,64 +93,159 @@ class BluetoothServer:
         self.getBluetoothConnection()
         self.advertiseBluetoothService()
 
-    def receiveMessage(self):
+    def startSession(self):
+        # the client socket may be an RFCOMM socket or any stand-in with the same interface (socketpair, TCP)
+        self.loop = asyncio.get_running_loop()
+        self.outgoing = asyncio.Queue()
+        self.decoder = MessageDecoder()
+        self.pending = deque()
+        self.notifier = Notifier(self)
+        self.encoder = ResponseEncoder()
+        # asyncio only takes BlockingIOError as "would block", PyBluez re-raises it as a BluetoothError;
+        # a plain socket on a duplicate of the descriptor raises what asyncio expects
+        self.transport = socket.socket(fileno=os.dup(self.clientSocket.fileno()))
+        self.transport.setblocking(False)
+        self.writerTask = self.loop.create_task(self.writeMessages())
+
+    async def endSession(self):
+        self.notifier.reset()
+        if self.notifier.counters:
+            print("Notifications:", self.notifier.summary())
+        if self.writerTask is not None:
+            self.writerTask.cancel()
+            try:
+                await self.writerTask
+            except asyncio.CancelledError:
+                pass
+            self.writerTask = None
+        if self.transport is not None:
+            # the client socket itself stays open until the session closes it
+            self.transport.close()
+            self.transport = None
+
+    async def receiveMessage(self):
+        # next complete message, or None once the connection is gone
         length = 1024
         try:
-            data = self.clientSocket.recv(length)
-            data = data.decode("utf-8")
-            data_json = json.loads(data)
-            return data_json
-        except (Exception, IOError, bt.BluetoothError):
+            while not self.pending:
+                data = await self.loop.sock_recv(self.transport, length)
+                if not data:
+                    return None
+                self.pending.extend(self.decoder.feed(data))
+            return self.pending.popleft()
+        except (IOError, bt.BluetoothError):
             pass
 
     def sendMessage(self, reply):
-        try:
-            self.clientSocket.send(reply)
-        except (bt.BluetoothError):
-
-            btServer.serverSocket.close()
-            btServer.clientSocket.close()
+        # safe from any thread, the writer task is the only one writing to the socket
+        self.loop.call_soon_threadsafe(self.outgoing.put_nowait, reply)
+
+    def sendResponse(self, action, message):
+        self.sendMessage(self.encoder.encode(action, message))
+        print(f"Sending {action}: {message}")
+        if action in RESULT_ACTIONS and self.firstResultLatency is None and self.connectedAt is not None:
+            self.firstResultLatency = time.time() - self.connectedAt
+            print("Reconnect to first result: %.2f seconds" % self.firstResultLatency)
+
+    def negotiateEncoding(self, encoding):
+        # unsupported requests fall back to JSON, the reply tells the client what it got
+        if encoding not in supported_encodings():
+            encoding = "json"
+        self.encoder = ResponseEncoder(encoding)
+        self.sendResponse("hello", encoding)
+
+    async def writeMessages(self):
+        while True:
+            reply = await self.outgoing.get()
+            try:
+                await self.loop.sock_sendall(self.transport, reply)
+            except (IOError, bt.BluetoothError):
+                print("Failed to send, closing the client connection ...")
+                # wakes the pending receive so the session ends
+                try:
+                    self.transport.shutdown(socket.SHUT_RDWR)
+                except (IOError, bt.BluetoothError):
+                    pass
+                return
+
+
+# Pipeline profile each service runs on, see Pipeline.PIPELINE_PROFILES. Two choices:
+# - "stereo" for obstacle and "detection" for elevator: each mode only builds its own cameras and the nn,
+#   but every mode switch rebuilds the device, a few seconds
+# - "switchable" for both: a mode switch pauses and resumes streams in a fraction of a second and the cameras of
+#   paused streams are stopped, so the nn idles without frames; a restarted camera needs a few frames to come back
+SERVICE_PROFILES = {
+    "obstacle": "switchable",
+    "elevator": "switchable",
+}
+# Device streams each service reads
+SERVICE_STREAMS = {
+    "obstacle": ("disparity",),
+    "elevator": ("rgb", "nn", "gray"),
+}
+# Detectors in worker processes, so their numpy and OpenCV work does not hold the GIL Bluetooth needs;
+# off until it measures faster on the Pi than the worker threads
+WORKER_PROCESSES = False
 
 
 class ServiceSwitcher:
-    def __init__(self, blue_server: BluetoothServer, dev: dai.Device):
+    def __init__(self, blue_server: BluetoothServer, pipe_manager: PipelineManger):
         self.blueServer = blue_server
-        self.dev = dev
+        self.pipeManager = pipe_manager
+        self.engine = pipe_manager.acquire_engine()
         self.currentService = None
 
-    def startReceiveMessage(self):
+    async def useProfile(self, mode):
+        # the services of a mode read from the engine of that mode's pipeline profile,
+        # a device rebuild runs off the event loop so queued replies still go out
+        self.engine = await asyncio.to_thread(self.pipeManager.switch_profile, SERVICE_PROFILES[mode])
+        self.pipeManager.set_streams(SERVICE_STREAMS[mode])
+
+    async def startReceiveMessage(self):
         terminate = True
         print("re-established connection")
+        self.blueServer.startSession()
         while terminate:
             try:
-                data = self.blueServer.receiveMessage()
+                data = await self.blueServer.receiveMessage()
                 # print("Received ", data)
+                if data is None:
+                    raise bt.BluetoothError("connection closed")
 
                 # Switching service mode
-                mode = data["mode"]
+                mode = data.get("mode") if isinstance(data, dict) else None
                 # print(self.currentService.name)
                 if mode == "obstacle":
                     if self.currentService is None:
                         print("Service begin ...")
                         self.logService("obstacle")
-                        self.currentService = ObstacleService(self.blueServer, dev=self.dev)
+                        await self.useProfile(mode)
+                        self.currentService = ObstacleService(self.blueServer, engine=self.engine)
                         self.currentService.runService()
                     elif self.currentService.name != "Obstacle Service":
                         self.logService("obstacle")
                         self.currentService.terminateService()
-                        self.currentService = ObstacleService(self.blueServer, dev=self.dev)
+                        await self.useProfile(mode)
+                        self.currentService = ObstacleService(self.blueServer, engine=self.engine)
                         self.currentService.runService()
 
                 elif mode == "elevator":
-                    if self.currentService.name != "Elevator Service":
+                    if self.currentService is None or self.currentService.name != "Elevator Service":
                         self.logService("elevator")
-                        self.currentService.terminateService()
-                        self.currentService = EscalatorService(self.blueServer, dev=self.dev)
+                        if self.currentService is not None:
+                            self.currentService.terminateService()
+                        await self.useProfile(mode)
+                        self.currentService = EscalatorService(self.blueServer, engine=self.engine)
                         self.currentService.runService()
 
+                elif mode == "hello":
+                    self.blueServer.negotiateEncoding(data.get("encoding", "json"))
+
                 elif mode == "stop":
-                    self.currentService.terminateService()
+                    if self.currentService is not None:
+                        self.currentService.terminateService()
                     self.currentService = None
+                    self.pipeManager.set_streams(())
                     print("Service stop ...")
 
                 else:
@@ -138,269 +253,126 @@ class ServiceSwitcher:
 
             except (bt.BluetoothError, TypeError):
                 print("Closing the client socket")
+                await self.blueServer.endSession()
                 # if self.blueServer.clientSocket is not None:
                 self.blueServer.clientSocket.close()
                 # self.blueServer.serverSocket.close()
                 terminate = False
+                # the device and engine stay up for the next client, with every stream paused
                 if self.currentService is not None:
                     self.currentService.terminateService()
-                pipe_device = pipe_manager.get_device()
-                if pipe_device is not None:
-                    pipe_device.close()
+                self.pipeManager.set_streams(())
 
     def logService(self, serviceName):
         print("Service Switcher: Starting", serviceName, "service ...")
 
 
+# time the phone gets to announce a mode switch before the first result
+SWITCH_MESSAGE_DELAY = 1.5
+
+
 def sendSwitchServiceResponse(bServer, mode):
     messageString = f"{mode}模式"
-    responseDict = {"action": "switch mode", "message": messageString}
-    jsonString = json.dumps(responseDict, indent=4)
-    response = jsonString.encode("utf-8")
-    bServer.sendMessage(response)
-    print(f"Sending {jsonString}")
-    time.sleep(1.5)
+    # results of the previous mode must not hold back or suppress the ones of the new mode
+    bServer.notifier.reset()
+    bServer.sendResponse("switch mode", messageString)
 
 
 class ObstacleService:
-    def __init__(self, bluetooth_server: BluetoothServer, dev: dai.Device):
+    def __init__(self, bluetooth_server: BluetoothServer, engine: FrameEngine):
         self.terminate = False
-        self.serviceThread = None
+        self.serviceTask = None
         self.name = "Obstacle Service"
         self.btServer = bluetooth_server
-        self.device = dev
-        self.detector = oDetector(device)
-
-    def _runService(self):
-        WAIT_TIME = 1
-        direction = []
-        cur_time = time.time()
-        timeout = cur_time + WAIT_TIME
-        while not self.terminate:
-            cur_time = time.time()
-            self.detector.get_guide(list_dir=direction, display=False)
-            if cur_time >= timeout:
-                timeout = cur_time + WAIT_TIME
-                count = Counter(direction)
-                msg = self.detector.get_direct_msg(count.most_common(1)[0][0])
-                direction = []
-                self.obstacleMode(msg)
-                time.sleep(3)
+        self.engine = engine
+        # ignore results left over from before this service started
+        self.maxResultAge = 1
 
+    async def _runService(self):
+        await asyncio.sleep(SWITCH_MESSAGE_DELAY)
+        last = time.time() - self.maxResultAge
+        while not self.terminate:
+            # the engine publishes a direction as soon as it changes and refreshes it every second,
+            # the notifier decides which of them the phone hears
+            result = await asyncio.to_thread(self.engine.results.wait, "obstacle", last, 1)
+            if result is None:
+                continue
+            last, (code, msg) = result
+            self.obstacleMode(msg)
 
     def runService(self):
+        self.engine.setActive("obstacle", True)
         sendSwitchServiceResponse(self.btServer, "障礙物")
-        self.serviceThread = threading.Thread(target=self._runService)
-        self.serviceThread.start()
+        self.serviceTask = asyncio.create_task(self._runService())
 
     def terminateService(self):
         print("Terminating", self.name, "...")
         self.terminate = True
+        self.engine.setActive("obstacle", False)
+        if self.serviceTask is not None:
+            self.serviceTask.cancel()
 
     def obstacleMode(self, result: str):
         if not self.terminate:
             self.sendResponse(result)
 
     def sendResponse(self, result):
-        responseDict = {"action": "obstacle detection", "message": result}
-        jsonString = json.dumps(responseDict, indent=4)
-        response = jsonString.encode("utf-8")
-        print(f"Sending {jsonString}")
-        self.btServer.sendMessage(response)
+        self.btServer.notifier.notify("obstacle detection", result)
 
 
 class EscalatorService:
-    def __init__(self, bluetooth_server: BluetoothServer, dev: dai.Device):
+    def __init__(self, bluetooth_server: BluetoothServer, engine: FrameEngine):
         self.terminate = False
-        self.serviceThread = None
+        self.serviceTask = None
         self.name = "Elevator Service"
         self.btServer = bluetooth_server
-        self.detector = eDetector(dev)
+        self.engine = engine
+        # a result this recent is still answered right away
+        self.maxResultAge = 2
 
-    def _runService(self):
-        global escalaIsRunning
+    async def _runService(self):
+        await asyncio.sleep(SWITCH_MESSAGE_DELAY)
+        last = time.time() - self.maxResultAge
         while not self.terminate:
-            if not escalaIsRunning:
-                escalaIsRunning = True
-                self.elevatorMode()
-                escalaIsRunning = False
-                # time.sleep(1)
+            result = await asyncio.to_thread(self.engine.results.wait, "escalator", last, 1)
+            if result is None:
+                continue
+            last, (status, msg, stats) = result
+            self.elevatorMode(status, msg)
 
     def runService(self):
+        self.engine.setActive("escalator", True)
         sendSwitchServiceResponse(self.btServer, "電梯")
-        self.serviceThread = threading.Thread(target=self._runService)
-        self.serviceThread.start()
+        self.serviceTask = asyncio.create_task(self._runService())
 
     def terminateService(self):
         print("Terminating", self.name, "...")
         self.terminate = True
+        self.engine.setActive("escalator", False)
+        if self.serviceTask is not None:
+            self.serviceTask.cancel()
 
-    def elevatorMode(self):
-        status, msg = self.detector.run()
-        # status = True
-        # msg = "escalator"
+    def elevatorMode(self, status, msg):
         if not self.terminate and status:
             self.sendResponse(msg)
 
     def sendResponse(self, result):
-        responseDict = {"action": "elevator direction", "message": result}
-        jsonString = json.dumps(responseDict, indent=4)
-        response = jsonString.encode("utf-8")
-        self.btServer.sendMessage(response)
-        print(f"Sending {jsonString}")
-
-
-class PipelineManger:
-    def __init__(self):
-        self.pipeline = None
-        self.device = None
-
-    def setup_pipeline(self):
-        extended_disparity = True
-        # for better accuracy for longer distances
-        subpixel = False
-        # better handling for occulsions:
-        lr_check = False
-        # Create pipeline
-        pipe = dai.Pipeline()
-
-        # nn model
-        nnPath = 'v5nModel_320/best_openvino_2021.4_6shave.blob'
-
-        # Define node
-        monoLeft = pipe.create(dai.node.MonoCamera)
-        monoRight = pipe.create(dai.node.MonoCamera)
-        stereo = pipe.create(dai.node.StereoDepth)
-        camRgb = pipe.create(dai.node.ColorCamera)
-        detectionNetwork = pipe.create(dai.node.YoloDetectionNetwork)
-        xout = pipe.create(dai.node.XLinkOut)
-        xoutRgb = pipe.create(dai.node.XLinkOut)
-        nnOut = pipe.create(dai.node.XLinkOut)
-
-        xout.setStreamName("disparity")
-        xoutRgb.setStreamName("rgb")
-        nnOut.setStreamName("nn")
-
-        # Setting properties for depth camera
-        monoLeft.setBoardSocket(dai.CameraBoardSocket.LEFT)
-        monoLeft.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
-        monoRight.setBoardSocket(dai.CameraBoardSocket.RIGHT)
-        monoRight.setResolution(dai.MonoCameraProperties.SensorResolution.THE_400_P)
-
-        # Depth node settings
-        stereo.setDefaultProfilePreset(dai.node.StereoDepth.PresetMode.HIGH_DENSITY)
-        # stereo.setRectifyEdgeFillColor(0)
-        stereo.initialConfig.setMedianFilter(dai.MedianFilter.KERNEL_7x7)
-        stereo.setLeftRightCheck(lr_check)
-        stereo.setExtendedDisparity(extended_disparity)
-        stereo.setSubpixel(subpixel)
-
-        config = stereo.initialConfig.get()
-        config.postProcessing.speckleFilter.enable = True
-        config.postProcessing.speckleFilter.speckleRange = 5
-        config.postProcessing.temporalFilter.enable = False
-        config.postProcessing.spatialFilter.enable = False
-        config.postProcessing.spatialFilter.holeFillingRadius = 2
-        config.postProcessing.spatialFilter.numIterations = 1
-        # config.postProcessing.thresholdFilter.minRange = 400
-        # config.postProcessing.thresholdFilter.maxRange = 270
-        config.postProcessing.decimationFilter.decimationFactor = 1
-        stereo.initialConfig.set(config)
-        # depth.initialConfig.setConfidenceThreshold(195)
-        stereo.initialConfig.setLeftRightCheckThreshold(30)
-
-        # camRgb.setPreviewSize(640, 640)
-        camRgb.setPreviewSize(320, 320)
-        camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_1080_P)
-        camRgb.setInterleaved(False)
-        camRgb.setColorOrder(dai.ColorCameraProperties.ColorOrder.BGR)
-        camRgb.setFps(50)
-
-        # Network specific settings
-        detectionNetwork.setConfidenceThreshold(0.6)
-        detectionNetwork.setNumClasses(3)
-        detectionNetwork.setCoordinateSize(4)
-
-        # 320 * 320
-        detectionNetwork.setAnchors([
-            10.0,
-            13.0,
-            16.0,
-            30.0,
-            33.0,
-            23.0,
-            30.0,
-            61.0,
-            62.0,
-            45.0,
-            59.0,
-            119.0,
-            116.0,
-            90.0,
-            156.0,
-            198.0,
-            373.0,
-            326.0
-        ])
-
-        detectionNetwork.setAnchorMasks({
-            "side40": [
-                0,
-                1,
-                2
-            ],
-            "side20": [
-                3,
-                4,
-                5
-            ],
-            "side10": [
-                6,
-                7,
-                8
-            ]
-        })
-
-        detectionNetwork.setIouThreshold(0.5)
-        detectionNetwork.setBlobPath(nnPath)
-        detectionNetwork.input.setBlocking(False)
-
-        # Linking
-        camRgb.preview.link(detectionNetwork.input)
-        detectionNetwork.passthrough.link(xoutRgb.input)
-        detectionNetwork.out.link(nnOut.input)
-        monoLeft.out.link(stereo.left)
-        monoRight.out.link(stereo.right)
-        stereo.disparity.link(xout.input)
-        self.pipeline = pipe
-
-    def create_device(self):
-        self.device = dai.Device(self.pipeline)
-        return self.device
-
-    def get_device(self):
-        return self.device
+        self.btServer.notifier.notify("elevator direction", result)
 
 
 if __name__ == '__main__':
     btServer = BluetoothServer()
-    pipe_manager = PipelineManger()
+    pipe_manager = PipelineManger(processes=WORKER_PROCESSES)
     btServer.startBluetoothServer()
-    pipe_manager.setup_pipeline()
+    # most sessions start in obstacle mode
+    pipe_manager.setup_pipeline(SERVICE_PROFILES["obstacle"])
     try:
         while True:
             btServer.acceptBluetoothConnection()
-            device = pipe_manager.get_device()
-            if device is not None:
-                device.close()
-            device = pipe_manager.create_device()
-
-            switchManager = ServiceSwitcher(btServer, dev=device)
-            switchManager.startReceiveMessage()
+            switchManager = ServiceSwitcher(btServer, pipe_manager)
+            asyncio.run(switchManager.startReceiveMessage())
     except (KeyboardInterrupt, SystemExit):
-        device = pipe_manager.get_device()
-        if device is not None:
-            device.close()
+        pipe_manager.close_device()
         btServer.serverSocket.close()
         btServer.clientSocket.close()
         if switchManager.currentService is not None:
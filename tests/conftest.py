@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FrameListQueue:
+    # get() hands out the given messages in order, like a ReplayQueue replaying as fast as possible
+    def __init__(self, msgs):
+        self.msgs = list(msgs)
+
+    def get(self):
+        if not self.msgs:
+            raise RuntimeError("End of frames")
+        return self.msgs.pop(0)
+
+    def tryGet(self):
+        return self.msgs.pop(0) if self.msgs else None
+
+    def tryGetAll(self):
+        msgs, self.msgs = self.msgs, []
+        return msgs
+
+
+class FrameListDevice:
+    # dai.Device stand-in serving a list of messages per stream, without a clock
+    def __init__(self, **streams):
+        self.queues = {name: FrameListQueue(msgs) for name, msgs in streams.items()}
+
+    def getOutputQueueNames(self):
+        return list(self.queues)
+
+    def getOutputQueue(self, name, maxSize=4, blocking=False):
+        return self.queues[name]
+
+    def clock(self):
+        return None
+
+
+@pytest.fixture
+def frame_device():
+    return FrameListDevice
@@ -0,0 +1,97 @@
+import asyncio
+import importlib.util
+import os
+import socket
+
+import pytest
+
+bt = pytest.importorskip("bluetooth")
+pytest.importorskip("depthai")
+
+
+def load_server():
+    # rfcomm-server.py is a script, its name is no module name
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rfcomm-server.py")
+    spec = importlib.util.spec_from_file_location("rfcomm_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+server_module = load_server()
+
+
+class PyBluezStyleSocket:
+    # Like PyBluez' BluetoothSocket: not a socket.socket, and every socket error of a call
+    # is re-raised as BluetoothError, a would-block one included
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __getattr__(self, name):
+        attr = getattr(self.sock, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            try:
+                return attr(*args)
+            except OSError as e:
+                raise bt.BluetoothError(*e.args)
+        return call
+
+
+@pytest.fixture(params=["socketpair", "pybluez"])
+def connection(request):
+    serverEnd, clientEnd = socket.socketpair()
+    clientEnd.setblocking(False)
+    wrapped = PyBluezStyleSocket(serverEnd) if request.param == "pybluez" else serverEnd
+    yield server_module.BluetoothServer(serverSocket=object(), clientSocket=wrapped), clientEnd
+    serverEnd.close()
+    clientEnd.close()
+
+
+async def read_exactly(sock, size):
+    loop = asyncio.get_running_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, 65536)
+        assert chunk, "connection closed early"
+        data += chunk
+    return data
+
+
+def test_receive_waits_for_an_idle_client(connection):
+    server, client = connection
+
+    async def session():
+        server.startSession()
+        try:
+            # the server reads before the client has sent anything
+            asyncio.get_running_loop().call_later(0.1, client.send, b'{"mode": "obstacle"}\n')
+            return await asyncio.wait_for(server.receiveMessage(), 2)
+        finally:
+            await server.endSession()
+
+    assert asyncio.run(session()) == {"mode": "obstacle"}
+
+
+def test_send_survives_a_full_send_buffer(connection):
+    server, client = connection
+    # more replies than the send buffer holds while the client is not reading yet,
+    # so the next reply starts on a full buffer
+    replies = [bytes([i % 256]) * 4096 for i in range(512)]
+
+    async def session():
+        server.startSession()
+        try:
+            for reply in replies:
+                server.sendMessage(reply)
+            server.sendResponse("obstacle detection", "向前走")
+            expected = b"".join(replies) + server.encoder.encode("obstacle detection", "向前走")
+            await asyncio.sleep(0.2)
+            return await asyncio.wait_for(read_exactly(client, len(expected)), 10), expected
+        finally:
+            await server.endSession()
+
+    received, expected = asyncio.run(session())
+    assert received == expected